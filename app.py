@@ -10,16 +10,42 @@ import os
 import datetime
 from functools import wraps
 import jwt  # PyJWT
-import io # Necessário para a função de exportar
-
+import click
+import io
+import threading
+import hashlib
+import math
+import sys
+import re
+import difflib
+import unicodedata
+import time
+from collections import namedtuple, OrderedDict, Counter
+import json
+import orjson
+import gzip
+import csv
+import tempfile
+import uuid
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+
+import brotli
+import numpy as np
 import pandas as pd
-from flask import Flask, request, jsonify, send_from_directory, send_file
+import xlsxwriter
+from PIL import Image, ImageOps
+from flask import Flask, request, jsonify, send_from_directory, send_file, g, stream_with_context, has_request_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func # Importação adicionada para uso em estatísticas
-from sqlalchemy.orm import joinedload
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import func, and_, or_, case, event, insert, inspect, exists, DDL # func: importação adicionada para uso em estatísticas
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
 
 # =======================================================================
@@ -46,14 +72,39 @@ if not DATABASE_URI:
 
 
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+TAREFAS_FOLDER = os.environ.get('TAREFAS_FOLDER', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tarefas'))
+IMAGENS_FOLDER = os.environ.get('IMAGENS_FOLDER', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'imagens_derivadas'))
 
 app.config['SECRET_KEY'] = SECRET_KEY
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB
+app.config['TAREFAS_FOLDER'] = TAREFAS_FOLDER
+app.config['TAREFAS_MAX_WORKERS'] = int(os.environ.get('TAREFAS_MAX_WORKERS', 2))
+app.config['AUTH_CACHE_TTL'] = float(os.environ.get('AUTH_CACHE_TTL', 60))  # segundos
+# Hash de senhas: método do Werkzeug (ex.: 'scrypt:32768:8:1'), processos dedicados e fila máxima
+app.config['SENHA_METODO'] = os.environ.get('SENHA_METODO', 'scrypt')
+app.config['SENHA_POOL_WORKERS'] = int(os.environ.get('SENHA_POOL_WORKERS', 2))
+app.config['SENHA_FILA_MAXIMA'] = int(os.environ.get('SENHA_FILA_MAXIMA', 8))
+app.config['LOGIN_MAX_FALHAS'] = int(os.environ.get('LOGIN_MAX_FALHAS', 5))
+app.config['LOGIN_JANELA_BLOQUEIO'] = int(os.environ.get('LOGIN_JANELA_BLOQUEIO', 300))  # segundos
+# Instrumentação: requisições com mais consultas SQL que o limite são sinalizadas (possível N+1)
+app.config['METRICAS_LIMITE_CONSULTAS'] = int(os.environ.get('METRICAS_LIMITE_CONSULTAS', 50))
+app.config['METRICAS_TOKEN'] = os.environ.get('METRICAS_TOKEN')  # Se definido, exigido em /metrics
+# Armazenamento de documentos por conteúdo: blobs sem referências há mais que a carência são removidos
+# pelo comando coletar-arquivos, que deve ser agendado periodicamente (cron)
+app.config['ARQUIVOS_CARENCIA_GC'] = int(os.environ.get('ARQUIVOS_CARENCIA_GC', 600))  # segundos
+# Cache de respostas das listagens (por worker), já comprimidas em gzip/brotli
+app.config['RESPOSTAS_CACHE_MAX_MB'] = int(os.environ.get('RESPOSTAS_CACHE_MAX_MB', 64))
+# Miniaturas/variantes de imagens: larguras permitidas (px) e tamanho máximo do cache em disco
+app.config['IMAGENS_FOLDER'] = IMAGENS_FOLDER
+app.config['IMAGENS_LARGURAS'] = [int(l) for l in os.environ.get('IMAGENS_LARGURAS', '160,480,1024').split(',')]
+app.config['IMAGENS_CACHE_MAX_MB'] = int(os.environ.get('IMAGENS_CACHE_MAX_MB', 512))
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['TAREFAS_FOLDER'], exist_ok=True)
+os.makedirs(app.config['IMAGENS_FOLDER'], exist_ok=True)
 
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
@@ -73,17 +124,17 @@ class Usuario(db.Model):
     def __init__(self, nome, usuario, senha, acesso='Usuario'):
         self.nome = nome
         self.usuario = usuario
-        self.senha_hash = generate_password_hash(senha, method="scrypt")
+        self.senha_hash = ServicoSenhas.gerar_hash(senha)
         self.acesso = acesso
 
     def verificar_senha(self, senha):
-        return check_password_hash(self.senha_hash, senha)
+        return ServicoSenhas.verificar(self.senha_hash, senha)
 
 
 class CadastroReurb(db.Model):
     __tablename__ = 'cadastros_reurb'
     id = db.Column(db.Integer, primary_key=True)
-    status = db.Column(db.String(50), default='Em Análise')
+    status = db.Column(db.String(50), default='Em Análise', index=True)
     latitude = db.Column(db.Float, nullable=True)
     longitude = db.Column(db.Float, nullable=True)
     data_criacao = db.Column(db.DateTime, default=datetime.datetime.utcnow)
@@ -112,10 +163,10 @@ class CadastroReurb(db.Model):
     # Etapa 2: Imóvel
     inscricao_imobiliaria = db.Column(db.String(30), index=True)
     imovel_cep = db.Column(db.String(15))
-    imovel_logradouro = db.Column(db.String(150))
+    imovel_logradouro = db.Column(db.String(150), index=True)
     imovel_numero = db.Column(db.String(20))
     imovel_complemento = db.Column(db.String(100))
-    imovel_bairro = db.Column(db.String(100))
+    imovel_bairro = db.Column(db.String(100), index=True)
     imovel_cidade = db.Column(db.String(100))
     imovel_uf = db.Column(db.String(2))
     confrontante_frente = db.Column(db.String(150), nullable=True)
@@ -154,21 +205,72 @@ class CadastroReurb(db.Model):
     reurb_outro_imovel = db.Column(db.String(10))
     reurb_cadunico = db.Column(db.String(10))
     reurb_propriedade = db.Column(db.String(20), nullable=True)
+
+    # Texto normalizado (sem acentos, minúsculo) para a busca: nomes, CPF, inscrição e logradouro
+    texto_busca = db.Column(db.Text, nullable=True)
+    # Versão 'cadastros' da última alteração do cadastro, de suas construções ou documentos (sincronização)
+    seq_alteracao = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')
+    # Chave enviada pelo aplicativo no cadastro em lote: reenvios não duplicam o cadastro
+    chave_idempotencia = db.Column(db.String(100), nullable=True, unique=True, index=True)
+    # Valores calculados, gravados junto com o cadastro e recalculados quando a PGV muda
+    tipo_reurb = db.Column(db.String(10), nullable=True)
+    vvt = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
+    vvc = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
+    vvi = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
+    iptu = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
+
+    __table_args__ = (
+        # Índice para as consultas por área do mapa (bbox/raio)
+        db.Index('ix_cadastros_reurb_lat_lon', 'latitude', 'longitude'),
+        # Feed de sincronização: alterações em ordem de (seq_alteracao, id)
+        db.Index('ix_cadastros_reurb_seq_alteracao', 'seq_alteracao', 'id'),
+        # Listagem ordenada por IPTU (paginação por (iptu, id))
+        db.Index('ix_cadastros_reurb_iptu', 'iptu', 'id'),
+        # Índice de trigramas para a busca (somente PostgreSQL, requer pg_trgm)
+        db.Index('ix_cadastros_reurb_texto_busca_trgm', 'texto_busca', postgresql_using='gin',
+                 postgresql_ops={'texto_busca': 'gin_trgm_ops'}).ddl_if(dialect='postgresql'),
+        # Filtro por prefixo da inscrição (LIKE 'x%') no PostgreSQL com collation não-C
+        db.Index('ix_cadastros_reurb_inscricao_pattern', 'inscricao_imobiliaria',
+                 postgresql_ops={'inscricao_imobiliaria': 'varchar_pattern_ops'}).ddl_if(dialect='postgresql'),
+    )
     
     # Relacionamentos
-    construcoes = db.relationship("Construcao", backref="cadastro", lazy=True, cascade="all, delete-orphan")
+    # Ordenadas por id: a alíquota do IPTU segue o uso da primeira construção
+    construcoes = db.relationship("Construcao", backref="cadastro", lazy=True, cascade="all, delete-orphan", order_by="Construcao.id")
     guias_iptu = db.relationship("GuiaIPTU", backref="cadastro", lazy=True, cascade="all, delete-orphan")
 
 
+event.listen(CadastroReurb.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+CAMPOS_BUSCA = ('req_nome', 'conj_nome', 'req_cpf', 'inscricao_imobiliaria', 'imovel_logradouro')
+
+def normalizar_busca(texto):
+    texto = unicodedata.normalize('NFKD', str(texto or ''))
+    texto = ''.join(caractere for caractere in texto if not unicodedata.combining(caractere)).lower()
+    return ' '.join(re.findall(r'[a-z0-9]+', texto))
+
+def montar_texto_busca(valores):
+    partes = [normalizar_busca(valores.get(campo)) for campo in CAMPOS_BUSCA]
+    # CPF e inscrição também só com dígitos, para casar buscas com ou sem pontuação
+    partes += [re.sub(r'\D', '', str(valores.get(campo) or '')) for campo in ('req_cpf', 'inscricao_imobiliaria')]
+    return ' '.join(parte for parte in partes if parte)
+
+@event.listens_for(CadastroReurb, 'before_insert')
+@event.listens_for(CadastroReurb, 'before_update')
+def atualizar_texto_busca_cadastro(mapper, connection, cadastro):
+    cadastro.texto_busca = montar_texto_busca({campo: getattr(cadastro, campo) for campo in CAMPOS_BUSCA})
+
+
 class Construcao(db.Model):
     __tablename__ = 'construcoes'
     id = db.Column(db.Integer, primary_key=True)
-    cadastro_id = db.Column(db.Integer, db.ForeignKey('cadastros_reurb.id'), nullable=False)
+    cadastro_id = db.Column(db.Integer, db.ForeignKey('cadastros_reurb.id'), nullable=False, index=True)
     
     nome = db.Column(db.String(150), nullable=False)
     area_construida = db.Column(db.Float)
-    uso_principal = db.Column(db.String(50))
-    padrao_construtivo = db.Column(db.String(100))
+    uso_principal = db.Column(db.String(50), index=True)
+    padrao_construtivo = db.Column(db.String(100), index=True)
     tipo_imovel = db.Column(db.String(50))
     
     estrutura = db.Column(db.String(50), nullable=True)
@@ -185,10 +287,11 @@ class GuiaIPTU(db.Model):
     __tablename__ = 'guias_iptu'
     id = db.Column(db.Integer, primary_key=True)
     cadastro_id = db.Column(db.Integer, db.ForeignKey('cadastros_reurb.id'), nullable=False)
-    ano_exercicio = db.Column(db.Integer, nullable=False)
+    ano_exercicio = db.Column(db.Integer, nullable=False, index=True)
     valor_emitido = db.Column(db.Float, nullable=False) 
     data_emissao = db.Column(db.DateTime, default=datetime.datetime.utcnow)
-    situacao = db.Column(db.String(20), default='Em aberto', nullable=False) # 'Pago' ou 'Em aberto'
+    situacao = db.Column(db.String(20), default='Em aberto', nullable=False, index=True) # 'Pago' ou 'Em aberto'
+    __table_args__ = (db.UniqueConstraint('cadastro_id', 'ano_exercicio', name='uq_guias_iptu_cadastro_ano'),)
 
     def to_dict(self):
         return {
@@ -203,18 +306,53 @@ class GuiaIPTU(db.Model):
 class Documento(db.Model):
     __tablename__ = 'documentos'
     id = db.Column(db.Integer, primary_key=True)
-    cadastro_id = db.Column(db.Integer, db.ForeignKey('cadastros_reurb.id'), nullable=False)
+    cadastro_id = db.Column(db.Integer, db.ForeignKey('cadastros_reurb.id'), nullable=False, index=True)
     nome_arquivo = db.Column(db.String(255), nullable=False)
     path_arquivo = db.Column(db.String(512), nullable=False)
     tipo_documento = db.Column(db.String(100))
     data_upload = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    sha256 = db.Column(db.String(64), nullable=True, index=True) # Nulo em documentos anteriores ao armazenamento por conteúdo
     cadastro = db.relationship("CadastroReurb", backref=db.backref("documentos", lazy=True, cascade="all, delete-orphan"))
 
 
+# Registro das exclusões (tombstones) para os clientes que sincronizam por /api/sincronizacao
+class Exclusao(db.Model):
+    __tablename__ = 'exclusoes'
+    id = db.Column(db.Integer, primary_key=True)
+    tabela = db.Column(db.String(30), nullable=False) # cadastros_reurb, construcoes ou documentos
+    registro_id = db.Column(db.Integer, nullable=False)
+    cadastro_id = db.Column(db.Integer, nullable=False)
+    seq_alteracao = db.Column(db.BigInteger, nullable=False)
+    data_exclusao = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_exclusoes_seq_alteracao', 'seq_alteracao', 'id'),)
+
+
+# Contagem de cadastros por combinação de dimensões do dashboard, mantida a cada alteração
+class ResumoCadastro(db.Model):
+    __tablename__ = 'resumo_cadastros'
+    status = db.Column(db.String(50), primary_key=True)
+    tipo_reurb = db.Column(db.String(10), primary_key=True)
+    risco_inundacao = db.Column(db.String(10), primary_key=True)
+    risco_deslizamento = db.Column(db.String(10), primary_key=True)
+    bairro = db.Column(db.String(100), primary_key=True)
+    quantidade = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Conteúdo dos documentos, armazenado uma única vez por hash SHA-256
+class ArquivoArmazenado(db.Model):
+    __tablename__ = 'arquivos_armazenados'
+    sha256 = db.Column(db.String(64), primary_key=True)
+    tamanho = db.Column(db.BigInteger, nullable=False)
+    referencias = db.Column(db.Integer, nullable=False, default=0)
+    data_criacao = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    data_liberacao = db.Column(db.DateTime, nullable=True, index=True) # Quando as referências chegaram a zero
+
+
 class PadraoConstrutivo(db.Model):
     __tablename__ = 'padroes_construtivos'
     id = db.Column(db.Integer, primary_key=True)
-    descricao = db.Column(db.String(150), nullable=False)
+    descricao = db.Column(db.String(150), nullable=False, index=True)
     valor_m2 = db.Column(db.Float, nullable=False)
 
 
@@ -231,44 +369,774 @@ class AliquotaIPTU(db.Model):
     tipo = db.Column(db.String(150), unique=True, nullable=False)
     aliquota = db.Column(db.Float, nullable=False)
 
+
+# Contador de versão por conjunto de dados. Cada escrita relevante incrementa
+# o contador na mesma transação, permitindo que os workers invalidem caches locais.
+class VersaoTabela(db.Model):
+    __tablename__ = 'versoes_tabelas'
+    nome = db.Column(db.String(50), primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Tarefas em segundo plano (importação, exportação, recálculos)
+class Tarefa(db.Model):
+    __tablename__ = 'tarefas'
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    tipo = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='Pendente') # 'Pendente', 'Em execução', 'Concluída' ou 'Erro'
+    progresso = db.Column(db.Float, nullable=False, default=0.0)
+    mensagem = db.Column(db.Text, nullable=True)
+    parametros = db.Column(db.Text, nullable=True) # JSON
+    resultado = db.Column(db.Text, nullable=True) # JSON
+    caminho_arquivo = db.Column(db.String(512), nullable=True)
+    nome_arquivo = db.Column(db.String(255), nullable=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'), nullable=True)
+    data_criacao = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    data_inicio = db.Column(db.DateTime, nullable=True)
+    data_conclusao = db.Column(db.DateTime, nullable=True)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'tipo': self.tipo,
+            'status': self.status,
+            'progresso': self.progresso,
+            'mensagem': self.mensagem,
+            'resultado': json.loads(self.resultado) if self.resultado else None,
+            'possui_arquivo': bool(self.caminho_arquivo),
+            'data_criacao': self.data_criacao.isoformat() if self.data_criacao else None,
+            'data_inicio': self.data_inicio.isoformat() if self.data_inicio else None,
+            'data_conclusao': self.data_conclusao.isoformat() if self.data_conclusao else None,
+        }
+
 # =======================================================================
 # SERVIÇOS E UTILIDADES
 # =======================================================================
 
+def obter_versao(nome):
+    return db.session.query(VersaoTabela.versao).filter_by(nome=nome).scalar() or 0
+
+def incrementar_versao(nome):
+    # Deve ser chamada antes do commit da alteração, para que versão e dados mudem juntos.
+    # A linha fica bloqueada até o commit, então as versões seguem a ordem dos commits.
+    tabela = VersaoTabela.__table__
+    versao = db.session.execute(tabela.update().where(tabela.c.nome == nome)
+                                .values(versao=tabela.c.versao + 1).returning(tabela.c.versao)).scalar()
+    if versao is None:
+        versao = 1
+        db.session.execute(tabela.insert().values(nome=nome, versao=versao))
+    return versao
+
+def obter_versoes(nomes):
+    versoes = dict(db.session.query(VersaoTabela.nome, VersaoTabela.versao).filter(VersaoTabela.nome.in_(nomes)))
+    return tuple(versoes.get(nome, 0) for nome in nomes)
+
+# Grupo de versão de cada modelo: alterações pelo ORM avançam a versão automaticamente no flush.
+# Gravações em massa (bulk_*_mappings) e UPDATEs diretos precisam chamar incrementar_versao.
+VERSOES_POR_MODELO = {
+    CadastroReurb: 'cadastros', Construcao: 'cadastros', Documento: 'cadastros', GuiaIPTU: 'guias',
+    ValorLogradouro: 'pgv', PadraoConstrutivo: 'pgv', AliquotaIPTU: 'pgv',
+}
+
+@event.listens_for(db.session, 'before_flush')
+def versionar_alteracoes(session, flush_context, instances):
+    alterados = list(session.new) + [obj for obj in session.dirty if session.is_modified(obj)]
+    nomes = {VERSOES_POR_MODELO.get(type(obj)) for obj in alterados + list(session.deleted)}
+    nomes.discard(None)
+    with session.no_autoflush:
+        versoes = {nome: incrementar_versao(nome) for nome in sorted(nomes)}
+        if 'cadastros' in versoes:
+            ResumoCadastrosService.registrar_flush(session)
+            for cadastro in registrar_alteracoes_sincronizacao(session, alterados, versoes['cadastros']):
+                CalculoTributarioService.atualizar_cadastro(cadastro, session)
+
+def registrar_alteracoes_sincronizacao(session, alterados, seq):
+    # Carimba seq_alteracao nos cadastros alterados (ou cujas construções/documentos mudaram)
+    # e grava um tombstone para cada cadastro, construção ou documento excluído.
+    # Retorna os cadastros carimbados.
+    def cadastro_de(obj):
+        return session.get(CadastroReurb, obj.cadastro_id) if obj.cadastro_id else obj.cadastro
+    carimbados = []
+    def carimbar(cadastro):
+        if cadastro is not None and cadastro not in session.deleted:
+            cadastro.seq_alteracao = seq
+            if cadastro not in carimbados: carimbados.append(cadastro)
+    for obj in alterados:
+        carimbar(obj if isinstance(obj, CadastroReurb) else cadastro_de(obj) if isinstance(obj, (Construcao, Documento)) else None)
+    for obj in list(session.deleted):
+        if not isinstance(obj, (CadastroReurb, Construcao, Documento)): continue
+        cadastro_id = obj.id if isinstance(obj, CadastroReurb) else obj.cadastro_id
+        session.add(Exclusao(tabela=obj.__tablename__, registro_id=obj.id, cadastro_id=cadastro_id, seq_alteracao=seq))
+        if not isinstance(obj, CadastroReurb):
+            carimbar(cadastro_de(obj))
+    return carimbados
+
+@event.listens_for(db.session, 'after_flush')
+def recalcular_apos_alteracao_pgv(session, flush_context):
+    # Com as linhas da PGV já gravadas, recalcula só os cadastros que usam os itens alterados
+    itens = [obj for obj in list(session.new) + list(session.dirty) + list(session.deleted)
+             if isinstance(obj, (ValorLogradouro, PadraoConstrutivo, AliquotaIPTU))]
+    if itens:
+        with session.no_autoflush:
+            CalculoTributarioService.recalcular(CalculoTributarioService.afetados_por_pgv(itens))
+
+
+class ResumoCadastrosService:
+    """
+    Mantém resumo_cadastros (quantidade por status, tipo de REURB, riscos e bairro)
+    aplicando a cada gravação só a diferença: +1 na combinação nova, -1 na antiga.
+    As gravações de cadastros já seguram a linha 'cadastros' de versoes_tabelas
+    até o commit, o que serializa as atualizações do resumo.
+    """
+    DIMENSOES = ('status', 'tipo_reurb', 'risco_inundacao', 'risco_deslizamento', 'bairro')
+    COLUNAS = ('status', 'reurb_renda_familiar', 'reurb_outro_imovel', 'risco_inundacao', 'risco_deslizamento', 'imovel_bairro')
+    STATUS_PADRAO = CadastroReurb.__table__.c.status.default.arg
+
+    @classmethod
+    def chave(cls, valores):
+        return (valores.get('status') or '', classificar_reurb(valores.get('reurb_renda_familiar'), valores.get('reurb_outro_imovel')),
+                valores.get('risco_inundacao') or '', valores.get('risco_deslizamento') or '', valores.get('imovel_bairro') or '')
+
+    @classmethod
+    def valores_novos(cls, dados):
+        # Cadastro ainda não inserido: o status ausente recebe o padrão da coluna
+        valores = {coluna: dados.get(coluna) for coluna in cls.COLUNAS}
+        if valores['status'] is None: valores['status'] = cls.STATUS_PADRAO
+        return valores
+
+    @classmethod
+    def registrar_flush(cls, session):
+        deltas = Counter()
+        for obj in session.new:
+            if isinstance(obj, CadastroReurb):
+                deltas[cls.chave(cls.valores_novos({coluna: getattr(obj, coluna) for coluna in cls.COLUNAS}))] += 1
+        for obj in list(session.dirty) + list(session.deleted):
+            if not isinstance(obj, CadastroReurb): continue
+            estado, atuais, antigos = inspect(obj), {}, {}
+            for coluna in cls.COLUNAS:
+                historico = estado.attrs[coluna].history
+                atuais[coluna] = getattr(obj, coluna)
+                antigos[coluna] = historico.deleted[0] if historico.deleted else atuais[coluna]
+            deltas[cls.chave(antigos)] -= 1
+            if obj not in session.deleted: deltas[cls.chave(atuais)] += 1
+        cls.aplicar(deltas)
+
+    @classmethod
+    def aplicar(cls, deltas):
+        tabela = ResumoCadastro.__table__
+        for chave, delta in deltas.items():
+            if not delta: continue
+            condicao = and_(*[tabela.c[dimensao] == valor for dimensao, valor in zip(cls.DIMENSOES, chave)])
+            if not db.session.execute(tabela.update().where(condicao).values(quantidade=tabela.c.quantidade + delta)).rowcount:
+                db.session.execute(tabela.insert().values(quantidade=delta, **dict(zip(cls.DIMENSOES, chave))))
+        if any(delta < 0 for delta in deltas.values()):
+            db.session.execute(tabela.delete().where(tabela.c.quantidade <= 0))
+
+    @classmethod
+    def reconstruir(cls):
+        """Recalcula o resumo inteiro a partir de cadastros_reurb (um GROUP BY). Não faz commit."""
+        incrementar_versao('cadastros')  # Bloqueia gravações concorrentes de cadastros até o commit
+        expressoes = [func.coalesce(CadastroReurb.status, ''),
+                      case((condicao_reurb_social(), 'REURB-S'), else_='REURB-E'),
+                      func.coalesce(CadastroReurb.risco_inundacao, ''),
+                      func.coalesce(CadastroReurb.risco_deslizamento, ''),
+                      func.coalesce(CadastroReurb.imovel_bairro, '')]
+        consulta = db.select(*expressoes, func.count()).group_by(*expressoes)
+        tabela = ResumoCadastro.__table__
+        db.session.execute(tabela.delete())
+        db.session.execute(tabela.insert().from_select(list(cls.DIMENSOES) + ['quantidade'], consulta))
+
+    @classmethod
+    def estatisticas(cls):
+        def rotulo(valor): return valor or 'Não informado'
+        resultado = {'total': 0, 'por_status': Counter(), 'por_tipo_reurb': Counter(),
+                     'risco_inundacao': Counter(), 'risco_deslizamento': Counter(), 'por_bairro': {}}
+        for linha in ResumoCadastro.query.all():
+            resultado['total'] += linha.quantidade
+            resultado['por_status'][rotulo(linha.status)] += linha.quantidade
+            resultado['por_tipo_reurb'][linha.tipo_reurb] += linha.quantidade
+            resultado['risco_inundacao'][rotulo(linha.risco_inundacao)] += linha.quantidade
+            resultado['risco_deslizamento'][rotulo(linha.risco_deslizamento)] += linha.quantidade
+            bairro = resultado['por_bairro'].setdefault(rotulo(linha.bairro), {'total': 0, 'REURB-S': 0, 'REURB-E': 0})
+            bairro['total'] += linha.quantidade
+            bairro[linha.tipo_reurb] += linha.quantidade
+        return resultado
+
+
+class PlantaGenericaCache:
+    """
+    Mapas em memória das tabelas da Planta Genérica de Valores (logradouros,
+    padrões construtivos e alíquotas). Cada worker mantém sua cópia e a recarrega
+    quando a versão 'pgv' no banco avança; a versão é consultada uma vez por requisição.
+    """
+    _lock = threading.Lock()
+    _versao = None
+    logradouros = {}
+    padroes = {}
+    aliquotas = {}
+
+    @classmethod
+    def obter(cls):
+        versao = g.get('pgv_versao')
+        if versao is None:
+            versao = g.pgv_versao = obter_versao('pgv')
+        if versao != cls._versao:
+            with cls._lock:
+                if versao != cls._versao:
+                    cls._carregar(versao)
+        return cls
+
+    @classmethod
+    def _carregar(cls, versao):
+        logradouros, padroes, aliquotas = {}, {}, {}
+        for nome, valor in db.session.query(ValorLogradouro.logradouro, ValorLogradouro.valor_m2).order_by(ValorLogradouro.id):
+            logradouros.setdefault(nome, valor)
+        for descricao, valor in db.session.query(PadraoConstrutivo.descricao, PadraoConstrutivo.valor_m2).order_by(PadraoConstrutivo.id):
+            padroes.setdefault(descricao, valor)
+        for tipo, aliquota in db.session.query(AliquotaIPTU.tipo, AliquotaIPTU.aliquota).order_by(AliquotaIPTU.id):
+            aliquotas.setdefault(tipo, aliquota)
+        cls.logradouros, cls.padroes, cls.aliquotas = logradouros, padroes, aliquotas
+        cls._versao = versao
+
+    @staticmethod
+    def invalidar():
+        incrementar_versao('pgv')
+        g.pop('pgv_versao', None)
+
+
+class ServicoSenhasOcupado(Exception):
+    pass
+
+class ServicoSenhas:
+    """
+    Executa o scrypt (caro em CPU e memória) num pool de processos limitado, fora
+    das threads que atendem requisições. Quando há mais de SENHA_POOL_WORKERS +
+    SENHA_FILA_MAXIMA operações pendentes, a chamada falha na hora com
+    ServicoSenhasOcupado (HTTP 503) em vez de enfileirar indefinidamente; o mesmo
+    vale quando a operação não termina em 30 segundos.
+    """
+    _executor = None
+    _vagas = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def _executar(cls, funcao, *args):
+        if app.config['SENHA_POOL_WORKERS'] <= 0:
+            return funcao(*args)
+        with cls._lock:
+            # Criado sob demanda para que cada worker do gunicorn tenha o seu (após o fork)
+            if cls._executor is None:
+                cls._executor = ProcessPoolExecutor(max_workers=app.config['SENHA_POOL_WORKERS'])
+                cls._vagas = threading.BoundedSemaphore(app.config['SENHA_POOL_WORKERS'] + app.config['SENHA_FILA_MAXIMA'])
+        if not cls._vagas.acquire(blocking=False):
+            raise ServicoSenhasOcupado()
+        try:
+            futuro = cls._executor.submit(funcao, *args)
+        except Exception:
+            cls._vagas.release()
+            raise
+        # A vaga só volta quando o processo termina, mesmo que a espera abaixo expire.
+        futuro.add_done_callback(lambda _: cls._vagas.release())
+        try:
+            return futuro.result(timeout=30)
+        except FuturesTimeoutError:
+            raise ServicoSenhasOcupado()
+
+    @classmethod
+    def gerar_hash(cls, senha):
+        return cls._executar(generate_password_hash, senha, app.config['SENHA_METODO'])
+
+    @classmethod
+    def verificar(cls, senha_hash, senha):
+        return cls._executar(check_password_hash, senha_hash, senha)
+
+
+class ControleTentativasLogin:
+    """
+    Bloqueia temporariamente um usuário após LOGIN_MAX_FALHAS senhas erradas na janela.
+    A contagem fica na memória do processo: com N workers do gunicorn, cada um aceita
+    as suas LOGIN_MAX_FALHAS tentativas, até N vezes esse total no pior caso.
+    """
+    _lock = threading.Lock()
+    _falhas = {}
+
+    @classmethod
+    def segundos_bloqueado(cls, usuario):
+        with cls._lock:
+            falhas = cls._falhas.get(usuario.lower())
+        if not falhas or len(falhas) < app.config['LOGIN_MAX_FALHAS']:
+            return 0
+        return max(0, int(falhas[0] + app.config['LOGIN_JANELA_BLOQUEIO'] - time.monotonic()) + 1)
+
+    @classmethod
+    def registrar_falha(cls, usuario):
+        agora, janela = time.monotonic(), app.config['LOGIN_JANELA_BLOQUEIO']
+        with cls._lock:
+            falhas = [instante for instante in cls._falhas.get(usuario.lower(), []) if instante > agora - janela]
+            falhas.append(agora)
+            cls._falhas[usuario.lower()] = falhas[-app.config['LOGIN_MAX_FALHAS']:]
+
+    @classmethod
+    def limpar(cls, usuario):
+        with cls._lock:
+            cls._falhas.pop(usuario.lower(), None)
+
+
+# Dados do usuário autenticado repassados às rotas como current_user
+UsuarioAutenticado = namedtuple('UsuarioAutenticado', ['id', 'nome', 'usuario', 'acesso'])
+
+class CacheUsuarios:
+    """
+    Cache com expiração (AUTH_CACHE_TTL) dos usuários referenciados pelos tokens,
+    evitando uma consulta a 'usuarios' em toda requisição autenticada.
+
+    O cache é por processo: invalidar só limpa a entrada do worker que processou a
+    alteração. Nos demais workers, um usuário excluído ou que perdeu o acesso de
+    Administrador continua aceito com os dados antigos por até AUTH_CACHE_TTL
+    segundos; reduza AUTH_CACHE_TTL (0 desativa o cache) se isso não for aceitável.
+    """
+    _lock = threading.Lock()
+    _entradas = {}
+
+    @classmethod
+    def obter(cls, usuario_id):
+        agora = time.monotonic()
+        entrada = cls._entradas.get(usuario_id)
+        if entrada and entrada[1] > agora:
+            return entrada[0]
+        usuario = db.session.query(Usuario.id, Usuario.nome, Usuario.usuario, Usuario.acesso).filter_by(id=usuario_id).first()
+        usuario = UsuarioAutenticado(*usuario) if usuario else None
+        with cls._lock:
+            if usuario:
+                cls._entradas[usuario_id] = (usuario, agora + app.config['AUTH_CACHE_TTL'])
+            else:
+                cls._entradas.pop(usuario_id, None)
+        return usuario
+
+    @classmethod
+    def invalidar(cls, usuario_id):
+        with cls._lock:
+            cls._entradas.pop(usuario_id, None)
+
+
+# Cadastro mínimo aceito por CalculoTributarioService.calcular_valores
+CadastroCalculo = namedtuple('CadastroCalculo', ['imovel_area_total', 'imovel_logradouro', 'construcoes'])
+
 class CalculoTributarioService:
+    """
+    tipo_reurb, vvt, vvc, vvi e iptu ficam gravados no cadastro. Alterações pelo ORM
+    são recalculadas no flush (atualizar_cadastro); gravações em massa e mudanças na
+    PGV usam recalcular, que aplica as mesmas regras com UPDATEs no banco.
+    """
     @staticmethod
     def calcular_valores(cadastro: CadastroReurb):
         vvt, vvc, vvi, iptu = 0.0, 0.0, 0.0, 0.0
         try:
+            pgv = PlantaGenericaCache.obter()
             area_total_terreno = float(cadastro.imovel_area_total or 0.0)
 
             if cadastro.imovel_logradouro and area_total_terreno > 0:
-                logradouro = ValorLogradouro.query.filter_by(logradouro=cadastro.imovel_logradouro).first()
-                if logradouro:
-                    vvt = area_total_terreno * logradouro.valor_m2
+                valor_m2_terreno = pgv.logradouros.get(cadastro.imovel_logradouro)
+                if valor_m2_terreno is not None:
+                    vvt = area_total_terreno * valor_m2_terreno
             
             vvc_total = 0.0
             if cadastro.construcoes:
                 for construcao in cadastro.construcoes:
                     area_construida = float(construcao.area_construida or 0.0)
                     if construcao.padrao_construtivo and area_construida > 0:
-                        padrao = PadraoConstrutivo.query.filter_by(descricao=construcao.padrao_construtivo).first()
-                        if padrao:
-                            vvc_total += area_construida * padrao.valor_m2
+                        valor_m2_construcao = pgv.padroes.get(construcao.padrao_construtivo)
+                        if valor_m2_construcao is not None:
+                            vvc_total += area_construida * valor_m2_construcao
             vvc = vvc_total
             
             vvi = vvt + vvc
 
             if vvi > 0 and cadastro.construcoes:
                 uso_principal_para_iptu = cadastro.construcoes[0].uso_principal
-                aliquota_data = AliquotaIPTU.query.filter_by(tipo=uso_principal_para_iptu).first()
-                if aliquota_data:
-                    iptu = vvi * aliquota_data.aliquota
+                aliquota = pgv.aliquotas.get(uso_principal_para_iptu)
+                if aliquota is not None:
+                    iptu = vvi * aliquota
 
         except Exception as e:
             print(f"Erro no cálculo: {e}")
         return {"vvt": vvt, "vvc": vvc, "vvi": vvi, "iptu": iptu}
 
+    @classmethod
+    def atualizar_cadastro(cls, cadastro, session):
+        construcoes = [construcao for construcao in cadastro.construcoes if construcao not in session.deleted]
+        valores = cls.calcular_valores(CadastroCalculo(cadastro.imovel_area_total, cadastro.imovel_logradouro, construcoes))
+        valores['tipo_reurb'] = classificar_reurb(cadastro.reurb_renda_familiar, cadastro.reurb_outro_imovel)
+        for campo, valor in valores.items():
+            if getattr(cadastro, campo) != valor: setattr(cadastro, campo, valor)
+
+    @staticmethod
+    def afetados_por_pgv(itens):
+        """Condição que seleciona os cadastros que usam os logradouros, padrões ou alíquotas alterados."""
+        def valores(obj, atributo):
+            # Inclui o valor anterior, caso o nome do item tenha sido alterado
+            return {getattr(obj, atributo), *inspect(obj).attrs[atributo].history.deleted}
+        logradouros, padroes, usos = set(), set(), set()
+        for obj in itens:
+            if isinstance(obj, ValorLogradouro): logradouros |= valores(obj, 'logradouro')
+            elif isinstance(obj, PadraoConstrutivo): padroes |= valores(obj, 'descricao')
+            else: usos |= valores(obj, 'tipo')
+        condicoes = [CadastroReurb.imovel_logradouro.in_(logradouros)] if logradouros else []
+        if padroes or usos:
+            construcoes = db.select(Construcao.cadastro_id).where(
+                or_(Construcao.padrao_construtivo.in_(padroes), Construcao.uso_principal.in_(usos)))
+            condicoes.append(CadastroReurb.id.in_(construcoes))
+        return or_(*condicoes)
+
+    @staticmethod
+    def recalcular(condicao, agora=None, seq=None):
+        """
+        Recalcula os valores dos cadastros que atendem à condição com dois UPDATEs
+        (mesmas regras de calcular_valores). Só as linhas cujos valores mudam são
+        gravadas, recebendo nova data_atualizacao e seq_alteracao. Não faz commit.
+        """
+        agora, seq = agora or datetime.datetime.utcnow(), seq or incrementar_versao('cadastros')
+        tabela = CadastroReurb.__table__
+        valor_terreno = db.select(ValorLogradouro.valor_m2).where(
+            ValorLogradouro.logradouro == CadastroReurb.imovel_logradouro).scalar_subquery()
+        vvt = case((CadastroReurb.imovel_area_total > 0, CadastroReurb.imovel_area_total * func.coalesce(valor_terreno, 0.0)), else_=0.0)
+        # Descrições repetidas: vale a primeira, como no PlantaGenericaCache
+        valor_padrao = db.select(PadraoConstrutivo.valor_m2).where(
+            PadraoConstrutivo.descricao == Construcao.padrao_construtivo).order_by(PadraoConstrutivo.id).limit(1).scalar_subquery()
+        vvc = func.coalesce(db.select(func.sum(Construcao.area_construida * func.coalesce(valor_padrao, 0.0))).where(
+            Construcao.cadastro_id == CadastroReurb.id, Construcao.area_construida > 0).scalar_subquery(), 0.0)
+        tipo_reurb = case((condicao_reurb_social(), 'REURB-S'), else_='REURB-E')
+        db.session.execute(tabela.update().where(condicao, or_(
+            CadastroReurb.tipo_reurb.is_distinct_from(tipo_reurb), CadastroReurb.vvt.is_distinct_from(vvt),
+            CadastroReurb.vvc.is_distinct_from(vvc))).values(
+            tipo_reurb=tipo_reurb, vvt=vvt, vvc=vvc, data_atualizacao=agora, seq_alteracao=seq))
+
+        # vvi e iptu a partir de vvt e vvc já gravados; a alíquota segue o uso da primeira construção
+        uso = (db.select(Construcao.uso_principal).where(Construcao.cadastro_id == CadastroReurb.id)
+               .order_by(Construcao.id).limit(1).correlate(CadastroReurb).scalar_subquery())
+        aliquota = db.select(AliquotaIPTU.aliquota).where(AliquotaIPTU.tipo == uso).scalar_subquery()
+        vvi = CadastroReurb.vvt + CadastroReurb.vvc
+        iptu = case((vvi > 0, vvi * func.coalesce(aliquota, 0.0)), else_=0.0)
+        db.session.execute(tabela.update().where(condicao, or_(
+            CadastroReurb.vvi.is_distinct_from(vvi), CadastroReurb.iptu.is_distinct_from(iptu))).values(
+            vvi=vvi, iptu=iptu, data_atualizacao=agora, seq_alteracao=seq))
+        return seq
+
+class SimulacaoIPTUService:
+    """
+    Simulação "what-if" da arrecadação de IPTU da cidade inteira. Carrega
+    cadastros e construções em colunas uma única vez e aplica as mesmas regras
+    de CalculoTributarioService de forma vetorizada. Não grava nada no banco.
+    """
+    @staticmethod
+    def carregar_base():
+        query_cadastros = db.session.query(CadastroReurb.id, CadastroReurb.imovel_bairro, CadastroReurb.imovel_logradouro,
+                                           CadastroReurb.imovel_area_total)
+        query_construcoes = db.session.query(Construcao.cadastro_id, Construcao.area_construida, Construcao.padrao_construtivo,
+                                             Construcao.uso_principal).order_by(Construcao.id)
+        cadastros = pd.DataFrame(query_cadastros.all(), columns=['id', 'bairro', 'logradouro', 'area_total'])
+        construcoes = pd.DataFrame(query_construcoes.all(), columns=['cadastro_id', 'area_construida', 'padrao', 'uso'])
+        return cadastros, construcoes
+
+    @staticmethod
+    def aplicar_proposta(mapa_atual, proposta):
+        # proposta: {"percentual": 10, "valores": {"Rua A": 150.0}} — valores explícitos prevalecem.
+        proposta = proposta or {}
+        percentual = to_float(proposta.get('percentual')) or 0.0
+        fator = 1 + percentual / 100
+        mapa = {chave: valor * fator for chave, valor in mapa_atual.items()}
+        for chave, valor in (proposta.get('valores') or {}).items():
+            valor_float = to_float(valor)
+            if valor_float is None: raise ValueError(f'Valor inválido para "{chave}": {valor}')
+            mapa[chave] = valor_float
+        return mapa
+
+    @staticmethod
+    def calcular(cadastros, construcoes, logradouros, padroes, aliquotas):
+        ids = cadastros['id'].to_numpy()
+
+        area_total = pd.to_numeric(cadastros['area_total'], errors='coerce').fillna(0.0).to_numpy(dtype=float)
+        valor_m2_terreno = cadastros['logradouro'].map(logradouros).fillna(0.0).to_numpy(dtype=float)
+        vvt = np.where(area_total > 0, area_total * valor_m2_terreno, 0.0)
+
+        area_construida = pd.to_numeric(construcoes['area_construida'], errors='coerce').fillna(0.0).to_numpy(dtype=float)
+        valor_m2_construcao = construcoes['padrao'].map(padroes).fillna(0.0).to_numpy(dtype=float)
+        parcelas = pd.Series(np.where(area_construida > 0, area_construida * valor_m2_construcao, 0.0))
+        vvc = parcelas.groupby(construcoes['cadastro_id'].to_numpy()).sum().reindex(ids, fill_value=0.0).to_numpy(dtype=float)
+
+        vvi = vvt + vvc
+
+        # A alíquota segue o uso da primeira construção do cadastro, como em calcular_valores.
+        primeira_construcao = construcoes.drop_duplicates('cadastro_id').set_index('cadastro_id')
+        aliquota = primeira_construcao['uso'].map(aliquotas).reindex(ids).fillna(0.0).to_numpy(dtype=float)
+        iptu = np.where(vvi > 0, vvi * aliquota, 0.0)
+
+        return {'vvt': vvt, 'vvc': vvc, 'vvi': vvi, 'iptu': iptu}
+
+    @classmethod
+    def simular(cls, propostas):
+        pgv = PlantaGenericaCache.obter()
+        cadastros, construcoes = cls.carregar_base()
+        atual = cls.calcular(cadastros, construcoes, pgv.logradouros, pgv.padroes, pgv.aliquotas)
+        simulado = cls.calcular(
+            cadastros, construcoes,
+            cls.aplicar_proposta(pgv.logradouros, propostas.get('logradouros')),
+            cls.aplicar_proposta(pgv.padroes, propostas.get('padroes')),
+            cls.aplicar_proposta(pgv.aliquotas, propostas.get('aliquotas')))
+
+        totais = {}
+        for campo in ('vvt', 'vvc', 'vvi', 'iptu'):
+            total_atual, total_simulado = float(atual[campo].sum()), float(simulado[campo].sum())
+            totais[campo] = {
+                'atual': total_atual, 'simulado': total_simulado,
+                'diferenca': total_simulado - total_atual,
+                'variacao_percentual': ((total_simulado / total_atual - 1) * 100) if total_atual else None,
+            }
+
+        por_bairro = pd.DataFrame({
+            'bairro': cadastros['bairro'].fillna('Sem bairro').to_numpy(),
+            'iptu_atual': atual['iptu'], 'iptu_simulado': simulado['iptu'],
+        }).groupby('bairro').agg(
+            quantidade=('iptu_atual', 'size'), iptu_atual=('iptu_atual', 'sum'), iptu_simulado=('iptu_simulado', 'sum'))
+        por_bairro['diferenca'] = por_bairro['iptu_simulado'] - por_bairro['iptu_atual']
+        bairros = [
+            {'bairro': bairro, 'quantidade': int(linha.quantidade), 'iptu_atual': float(linha.iptu_atual),
+             'iptu_simulado': float(linha.iptu_simulado), 'diferenca': float(linha.diferenca)}
+            for bairro, linha in por_bairro.sort_values('diferenca').iterrows()
+        ]
+        return {'quantidade_cadastros': int(len(cadastros)), 'totais': totais, 'por_bairro': bairros}
+
+class TarefaService:
+    """
+    Executa tarefas longas fora da requisição HTTP num pool local de threads.
+    O estado fica na tabela 'tarefas' e o arquivo de resultado em TAREFAS_FOLDER.
+    Cada tipo registrado recebe (tarefa_id, parametros, progresso) e retorna um
+    dict de resumo; a chave opcional 'arquivo' = (caminho, nome) indica o artefato.
+    Tipos registrados com admin=True só podem ser iniciados por administradores;
+    os registrados com interna=True só são submetidos pelo próprio servidor.
+    """
+    tipos = {}
+    somente_admin = set()
+    internas = set()
+    _executor = ThreadPoolExecutor(max_workers=app.config['TAREFAS_MAX_WORKERS'], thread_name_prefix='tarefa')
+
+    @classmethod
+    def registrar(cls, tipo, admin=False, interna=False):
+        def decorator(f):
+            cls.tipos[tipo] = f
+            if admin: cls.somente_admin.add(tipo)
+            if interna: cls.internas.add(tipo)
+            return f
+        return decorator
+
+    @classmethod
+    def submeter(cls, tipo, parametros, usuario_id=None):
+        if tipo not in cls.tipos:
+            raise ValueError(f'Tipo de tarefa inválido: {tipo}')
+        tarefa = Tarefa(tipo=tipo, parametros=json.dumps(parametros or {}), usuario_id=usuario_id)
+        db.session.add(tarefa)
+        db.session.commit()
+        cls._executor.submit(cls._executar, tarefa.id)
+        return tarefa
+
+    @staticmethod
+    def caminho_resultado(tarefa_id, extensao):
+        return os.path.join(app.config['TAREFAS_FOLDER'], f'{tarefa_id}.{extensao}')
+
+    @staticmethod
+    def atualizar_progresso(tarefa_id, progresso, mensagem=None):
+        # Conexão própria: não interfere na transação (nem no cursor) da tarefa em execução.
+        valores = {'progresso': round(min(max(progresso, 0.0), 100.0), 1)}
+        if mensagem is not None: valores['mensagem'] = mensagem
+        with db.engine.begin() as conn:
+            conn.execute(Tarefa.__table__.update().where(Tarefa.__table__.c.id == tarefa_id).values(**valores))
+
+    @classmethod
+    def _executar(cls, tarefa_id):
+        with app.app_context():
+            tarefa = Tarefa.query.get(tarefa_id)
+            tarefa.status, tarefa.data_inicio = 'Em execução', datetime.datetime.utcnow()
+            db.session.commit()
+            try:
+                progresso = lambda valor, mensagem=None: cls.atualizar_progresso(tarefa_id, valor, mensagem)
+                resultado = cls.tipos[tarefa.tipo](tarefa_id, json.loads(tarefa.parametros or '{}'), progresso) or {}
+                db.session.commit()
+                tarefa = Tarefa.query.get(tarefa_id)
+                if 'arquivo' in resultado:
+                    tarefa.caminho_arquivo, tarefa.nome_arquivo = resultado.pop('arquivo')
+                tarefa.resultado = json.dumps(resultado, default=str)
+                tarefa.status, tarefa.progresso, tarefa.mensagem = 'Concluída', 100.0, None
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Erro na tarefa {tarefa_id}: {str(e)}")
+                tarefa = Tarefa.query.get(tarefa_id)
+                tarefa.status, tarefa.mensagem = 'Erro', str(e)
+            tarefa.data_conclusao = datetime.datetime.utcnow()
+            db.session.commit()
+
+
+class ArmazenamentoArquivos:
+    """
+    Guarda o conteúdo dos documentos em UPLOAD_FOLDER/blobs/<aa>/<sha256>, uma
+    única vez por conteúdo, com contagem de referências em 'arquivos_armazenados'.
+    Blobs sem referências são apagados pelo comando coletar-arquivos depois de
+    ARQUIVOS_CARENCIA_GC segundos, nunca dentro da requisição que excluiu o documento.
+    O comando deve ser agendado periodicamente (cron), por exemplo a cada hora:
+        0 * * * * flask --app app coletar-arquivos
+    Arquivos antigos (gravados fora dos blobs) não são compartilhados e são removidos
+    logo após a exclusão pela tarefa interna 'coleta_arquivos'.
+    """
+    TAMANHO_BLOCO = 1024 * 1024
+
+    @staticmethod
+    def caminho_blob(sha256):
+        return os.path.join(app.config['UPLOAD_FOLDER'], 'blobs', sha256[:2], sha256)
+
+    @classmethod
+    def salvar(cls, stream):
+        """Grava o stream em disco calculando o hash; retorna (sha256, tamanho). Não faz commit."""
+        pasta_temporaria = os.path.join(app.config['UPLOAD_FOLDER'], 'blobs', 'tmp')
+        os.makedirs(pasta_temporaria, exist_ok=True)
+        hash_conteudo, tamanho = hashlib.sha256(), 0
+        with tempfile.NamedTemporaryFile(dir=pasta_temporaria, delete=False) as temporario:
+            for bloco in iter(lambda: stream.read(cls.TAMANHO_BLOCO), b''):
+                hash_conteudo.update(bloco)
+                temporario.write(bloco)
+                tamanho += len(bloco)
+        sha256 = hash_conteudo.hexdigest()
+        try:
+            cls.referenciar(sha256, tamanho)
+            caminho = cls.caminho_blob(sha256)
+            os.makedirs(os.path.dirname(caminho), exist_ok=True)
+            os.replace(temporario.name, caminho)  # Conteúdo idêntico: substituir é seguro e atômico
+        finally:
+            if os.path.exists(temporario.name): os.remove(temporario.name)
+        return sha256, tamanho
+
+    @staticmethod
+    def referenciar(sha256, tamanho):
+        tabela = ArquivoArmazenado.__table__
+        atualizados = db.session.execute(tabela.update().where(tabela.c.sha256 == sha256).values(
+            referencias=tabela.c.referencias + 1, data_liberacao=None)).rowcount
+        if not atualizados:
+            db.session.add(ArquivoArmazenado(sha256=sha256, tamanho=tamanho, referencias=1))
+            db.session.flush()
+
+    @classmethod
+    def liberar(cls, documentos):
+        """
+        Decrementa as referências dos documentos excluídos. Retorna os parâmetros da
+        tarefa 'coleta_arquivos' para os arquivos antigos (sem sha256), ou None. Não faz commit.
+        """
+        tabela, agora = ArquivoArmazenado.__table__, datetime.datetime.utcnow()
+        contagem, caminhos_legados = {}, []
+        for documento in documentos:
+            if documento.sha256: contagem[documento.sha256] = contagem.get(documento.sha256, 0) + 1
+            elif documento.path_arquivo and cls.caminho_legado_valido(documento.path_arquivo):
+                caminhos_legados.append(documento.path_arquivo)
+        for sha256, quantidade in contagem.items():
+            db.session.execute(tabela.update().where(tabela.c.sha256 == sha256).values(referencias=tabela.c.referencias - quantidade))
+            db.session.execute(tabela.update().where(tabela.c.sha256 == sha256, tabela.c.referencias <= 0).values(data_liberacao=agora))
+        return {'caminhos_legados': caminhos_legados} if caminhos_legados else None
+
+    @staticmethod
+    def caminho_legado_valido(caminho):
+        # Só arquivos dentro de UPLOAD_FOLDER e fora da área de blobs; qualquer outro caminho é ignorado
+        pasta_uploads = os.path.realpath(app.config['UPLOAD_FOLDER'])
+        caminho = os.path.realpath(caminho)
+        if os.path.commonpath([pasta_uploads, caminho]) != pasta_uploads or caminho == pasta_uploads: return None
+        if os.path.commonpath([os.path.join(pasta_uploads, 'blobs'), caminho]) == os.path.join(pasta_uploads, 'blobs'): return None
+        return caminho
+
+    @classmethod
+    def coletar(cls, caminhos_legados=()):
+        """Remove blobs sem referências há mais de ARQUIVOS_CARENCIA_GC segundos e arquivos legados."""
+        removidos = 0
+        for caminho in caminhos_legados:
+            caminho = cls.caminho_legado_valido(caminho)
+            if caminho and os.path.isfile(caminho):
+                os.remove(caminho)
+                removidos += 1
+        limite = datetime.datetime.utcnow() - datetime.timedelta(seconds=app.config['ARQUIVOS_CARENCIA_GC'])
+        tabela = ArquivoArmazenado.__table__
+        candidatos = [sha256 for (sha256,) in db.session.query(ArquivoArmazenado.sha256).filter(
+            ArquivoArmazenado.referencias <= 0, ArquivoArmazenado.data_liberacao < limite)]
+        for sha256 in candidatos:
+            # A condição é reavaliada: um upload concorrente pode ter voltado a referenciar o blob.
+            excluido = db.session.execute(tabela.delete().where(tabela.c.sha256 == sha256, tabela.c.referencias <= 0)).rowcount
+            db.session.commit()
+            if excluido and os.path.exists(cls.caminho_blob(sha256)):
+                os.remove(cls.caminho_blob(sha256))
+                removidos += 1
+        return {'removidos': removidos}
+
+
+@TarefaService.registrar('coleta_arquivos', interna=True)
+def tarefa_coleta_arquivos(tarefa_id, parametros, progresso):
+    return ArmazenamentoArquivos.coletar(parametros.get('caminhos_legados') or [])
+
+class ImagensDerivadas:
+    """
+    Gera sob demanda miniaturas (WebP ou JPEG) das imagens enviadas e as mantém
+    em IMAGENS_FOLDER. A data de modificação de cada variante é atualizada a cada
+    uso, e as menos usadas são removidas quando o cache passa de IMAGENS_CACHE_MAX_MB.
+    """
+    FORMATOS = {'webp': ('WEBP', 'image/webp'), 'jpeg': ('JPEG', 'image/jpeg')}
+    _lock = threading.Lock()
+    _tamanho_cache = None  # Bytes em disco; calculado na primeira geração
+
+    @staticmethod
+    def chave_origem(caminho, sha256=None):
+        # Documentos novos já têm hash do conteúdo; para os antigos usa caminho + mtime + tamanho
+        if sha256: return sha256
+        estado = os.stat(caminho)
+        return hashlib.sha256(f'{caminho}:{estado.st_mtime_ns}:{estado.st_size}'.encode()).hexdigest()
+
+    @classmethod
+    def obter(cls, caminho_origem, chave, largura, formato):
+        """Retorna o caminho da variante, gerando-a se ainda não existir."""
+        destino = os.path.join(app.config['IMAGENS_FOLDER'], f'{chave}_{largura}.{formato}')
+        if os.path.exists(destino):
+            os.utime(destino)  # Marca como usada recentemente (LRU)
+            return destino
+        with Image.open(caminho_origem) as imagem:
+            imagem.draft('RGB', (largura, largura))  # JPEG: decodifica já reduzido, bem mais rápido
+            imagem = ImageOps.exif_transpose(imagem)
+            imagem.thumbnail((largura, largura))
+            if formato == 'jpeg':
+                imagem = imagem.convert('RGB')
+            elif imagem.mode not in ('RGB', 'RGBA'):
+                imagem = imagem.convert('RGBA' if 'A' in imagem.getbands() or 'transparency' in imagem.info else 'RGB')
+            with tempfile.NamedTemporaryFile(dir=app.config['IMAGENS_FOLDER'], suffix='.tmp', delete=False) as temporario:
+                imagem.save(temporario, cls.FORMATOS[formato][0], quality=80)
+        os.replace(temporario.name, destino)
+        cls._registrar_geracao(destino)
+        return destino
+
+    @classmethod
+    def _registrar_geracao(cls, destino):
+        limite = app.config['IMAGENS_CACHE_MAX_MB'] * 1024 * 1024
+        with cls._lock:
+            if cls._tamanho_cache is None:
+                cls._tamanho_cache = sum(e.stat().st_size for e in os.scandir(app.config['IMAGENS_FOLDER']) if e.is_file())
+            else:
+                cls._tamanho_cache += os.path.getsize(destino)
+            if cls._tamanho_cache <= limite: return
+            # Remove as variantes usadas há mais tempo até ficar em 90% do limite (exceto a recém-gerada)
+            entradas = sorted((e for e in os.scandir(app.config['IMAGENS_FOLDER'])
+                               if e.is_file() and not e.name.endswith('.tmp')), key=lambda e: e.stat().st_mtime)
+            total = sum(e.stat().st_size for e in entradas)
+            entradas = [e for e in entradas if e.path != destino]
+            for entrada in entradas:
+                if total <= limite * 0.9: break
+                try:
+                    tamanho_entrada = entrada.stat().st_size
+                    os.remove(entrada.path)
+                    total -= tamanho_entrada
+                except FileNotFoundError:
+                    pass
+            cls._tamanho_cache = total
+
 # =======================================================================
 # DECORADORES E FUNÇÕES AUXILIARES
 # =======================================================================
@@ -286,6 +1154,305 @@ def to_int(value):
     except (ValueError, TypeError): return None
 
 
+def classificar_reurb(renda, outro_imovel):
+    renda, outro_imovel = renda or 0, outro_imovel or ''
+    return 'REURB-S' if renda <= 7500 and outro_imovel.lower() == 'nao' else 'REURB-E'
+
+def condicao_reurb_social():
+    # Equivalente SQL de classificar_reurb(...) == 'REURB-S'
+    return and_(func.coalesce(CadastroReurb.reurb_renda_familiar, 0) <= 7500,
+                func.lower(func.coalesce(CadastroReurb.reurb_outro_imovel, '')) == 'nao')
+
+
+# ------------------ LISTAGEM DE CADASTROS (FILTROS E PROJEÇÃO) ------------------
+LIMITE_MAXIMO_PAGINA = 1000
+# Colunas mantidas por CalculoTributarioService (não são editáveis nem importadas)
+CAMPOS_CALCULADOS_CADASTRO = ('tipo_reurb', 'vvt', 'vvc', 'vvi', 'iptu')
+# Colunas de uso interno (índice de busca e deduplicação de envios), fora das respostas e exportações
+COLUNAS_INTERNAS_CADASTRO = ('texto_busca', 'chave_idempotencia')
+COLUNAS_PUBLICAS_CADASTRO = [col for col in CadastroReurb.__table__.columns.keys() if col not in COLUNAS_INTERNAS_CADASTRO]
+# Campos montados na serialização e as colunas de que dependem. None indica que dependem das construções.
+DEPENDENCIAS_CAMPOS_CALCULADOS = {
+    'imovel_area_construida': (None,),
+    'construcoes': (None,),
+}
+
+def parse_data_filtro(valor, fim_do_intervalo=False):
+    try:
+        data = datetime.datetime.fromisoformat(valor)
+    except ValueError:
+        raise ValueError(f'Data inválida: {valor}. Use o formato AAAA-MM-DD.')
+    # Datas sem horário no limite superior incluem o dia inteiro.
+    if fim_do_intervalo and len(valor) == 10:
+        data += datetime.timedelta(days=1)
+    return data
+
+FILTROS_TEXTUAIS_CADASTRO = ('status', 'bairro', 'tipo_reurb', 'inscricao', 'criado_de', 'criado_ate', 'atualizado_de', 'atualizado_ate')
+
+def filtrar_cadastros(query, args):
+    # Os filtros também chegam em JSON (emissão em lote), onde podem vir com outros tipos.
+    for parametro in FILTROS_TEXTUAIS_CADASTRO:
+        if args.get(parametro) is not None and not isinstance(args[parametro], str):
+            raise ValueError(f'{parametro} deve ser um texto.')
+    if args.get('status'):
+        query = query.filter(CadastroReurb.status == args['status'])
+    if args.get('bairro'):
+        query = query.filter(CadastroReurb.imovel_bairro == args['bairro'])
+    if args.get('tipo_reurb'):
+        if args['tipo_reurb'] not in ('REURB-S', 'REURB-E'):
+            raise ValueError('tipo_reurb deve ser "REURB-S" ou "REURB-E".')
+        query = query.filter(CadastroReurb.tipo_reurb == args['tipo_reurb'])
+    for parametro in ('iptu_min', 'iptu_max'):
+        if args.get(parametro) not in (None, ''):
+            valor = to_float(args[parametro])
+            if valor is None: raise ValueError(f'{parametro} deve ser um número.')
+            query = query.filter(CadastroReurb.iptu >= valor if parametro == 'iptu_min' else CadastroReurb.iptu <= valor)
+    if args.get('inscricao'):
+        query = query.filter(CadastroReurb.inscricao_imobiliaria.startswith(args['inscricao'], autoescape=True))
+    for parametro, coluna in (('criado', CadastroReurb.data_criacao), ('atualizado', CadastroReurb.data_atualizacao)):
+        if args.get(f'{parametro}_de'):
+            query = query.filter(coluna >= parse_data_filtro(args[f'{parametro}_de']))
+        if args.get(f'{parametro}_ate'):
+            data_ate = args[f'{parametro}_ate']
+            if len(data_ate) == 10:
+                query = query.filter(coluna < parse_data_filtro(data_ate, fim_do_intervalo=True))
+            else:
+                query = query.filter(coluna <= parse_data_filtro(data_ate))
+    return query
+
+def campos_do_parametro(fields):
+    # fields=a,b,c -> ['a', 'b', 'c']; ausente -> None (todos os campos)
+    if not fields: return None
+    return [campo.strip() for campo in fields.split(',') if campo.strip()] or None
+
+def resolver_campos_cadastro(campos):
+    """
+    Recebe a lista de campos pedidos (None = todos). Retorna os campos de saída,
+    as colunas a selecionar e se as construções são necessárias.
+    """
+    colunas_validas = COLUNAS_PUBLICAS_CADASTRO
+    if not campos:
+        return None, colunas_validas, True
+    invalidos = [campo for campo in campos if campo not in colunas_validas and campo not in DEPENDENCIAS_CAMPOS_CALCULADOS]
+    if invalidos:
+        raise ValueError(f'Campos inválidos: {", ".join(invalidos)}')
+    colunas, precisa_construcoes = {'id'}, False
+    for campo in campos:
+        for dependencia in DEPENDENCIAS_CAMPOS_CALCULADOS.get(campo, (campo,)):
+            if dependencia is None: precisa_construcoes = True
+            else: colunas.add(dependencia)
+    return ['id'] + [campo for campo in campos if campo != 'id'], [c for c in colunas_validas if c in colunas], precisa_construcoes
+
+COLUNAS_CONSTRUCAO = Construcao.__table__.columns.keys()
+
+class SerializadorCadastros:
+    """
+    Serializa cadastros a partir de tuplas do Core, sem instanciar objetos do ORM.
+    É montado uma vez por conjunto de campos (?fields=) e reaproveitado: a lista de
+    colunas, as posições e os campos calculados ficam resolvidos na construção.
+    Datas saem como datetime e são codificadas diretamente pelo orjson.
+    """
+    _instancias = {}
+    LIMITE_INSTANCIAS = 256
+
+    @classmethod
+    def para(cls, campos):
+        chave = tuple(campos) if campos else None
+        serializador = cls._instancias.get(chave)
+        if serializador is None:
+            serializador = cls(campos)  # ValueError para campos inválidos
+            if len(cls._instancias) >= cls.LIMITE_INSTANCIAS: cls._instancias.clear()
+            cls._instancias[chave] = serializador
+        return serializador
+
+    def __init__(self, campos):
+        campos, colunas, self.precisa_construcoes = resolver_campos_cadastro(campos)
+        todas = COLUNAS_PUBLICAS_CADASTRO
+        if campos is None: campos = list(todas) + list(DEPENDENCIAS_CAMPOS_CALCULADOS)
+        # As colunas pedidas vêm primeiro na consulta: dict(zip(nomes, linha)) descarta as dependências do fim
+        self.nomes = [campo for campo in campos if campo in todas]
+        selecionadas = self.nomes + [coluna for coluna in colunas if coluna not in self.nomes]
+        self.colunas_sql = [CadastroReurb.__table__.c[coluna] for coluna in selecionadas]
+        posicao = {coluna: indice for indice, coluna in enumerate(selecionadas)}
+        calculados = [campo for campo in campos if campo in DEPENDENCIAS_CAMPOS_CALCULADOS]
+        self.posicao_id = posicao['id']
+        self.inclui_construcoes = 'construcoes' in calculados
+        self.inclui_area_construida = 'imovel_area_construida' in calculados
+
+    def consulta(self):
+        return db.session.query(*self.colunas_sql)
+
+    def _construcoes_por_cadastro(self, ids):
+        grupos = {}
+        linhas = db.session.query(Construcao.__table__).filter(Construcao.cadastro_id.in_(ids)).order_by(Construcao.cadastro_id, Construcao.id)
+        for linha in linhas:
+            grupos.setdefault(linha.cadastro_id, []).append(linha)
+        return grupos
+
+    def serializar(self, linhas):
+        """Lista de tuplas da consulta -> lista de dicts. As construções vêm numa única consulta."""
+        construcoes = self._construcoes_por_cadastro([linha[self.posicao_id] for linha in linhas]) if self.precisa_construcoes and linhas else {}
+        nomes, saida = self.nomes, []
+        for linha in linhas:
+            item = dict(zip(nomes, linha))
+            lista = construcoes.get(linha[self.posicao_id], ())
+            if self.inclui_construcoes:
+                item['construcoes'] = [dict(zip(COLUNAS_CONSTRUCAO, construcao)) for construcao in lista]
+            if self.inclui_area_construida:
+                item['imovel_area_construida'] = sum(construcao.area_construida or 0 for construcao in lista)
+            saida.append(item)
+        return saida
+
+    def em_lotes(self, query, tamanho=None):
+        """Serializa a consulta em lotes, sem carregar todas as linhas (streaming e exportação)."""
+        tamanho = tamanho or TAMANHO_LOTE_STREAMING
+        resultado = iter(query.yield_per(tamanho))
+        while True:
+            lote = list(itertools.islice(resultado, tamanho))
+            if not lote: return
+            yield from self.serializar(lote)
+
+
+# ------------------ EXPORTAÇÃO (XLSX/CSV EM MEMÓRIA CONSTANTE) ------------------
+FORMATOS_EXPORTACAO = ('xlsx', 'csv')
+
+def colunas_exportaveis(colunas_selecionadas):
+    # Mantém a ordem escolhida pelo usuário, descartando colunas desconhecidas.
+    permitidas = set(COLUNAS_PUBLICAS_CADASTRO) | (set(DEPENDENCIAS_CAMPOS_CALCULADOS) - {'construcoes'})
+    return [col for col in colunas_selecionadas if col in permitidas]
+
+def linhas_exportacao(colunas, ao_processar=None):
+    """Gera as linhas (listas de valores na ordem de colunas) lendo só as colunas necessárias."""
+    serializador = SerializadorCadastros.para(colunas)
+    query = serializador.consulta().order_by(CadastroReurb.id)
+    for numero, valores in enumerate(serializador.em_lotes(query), start=1):
+        yield [formatar_valor_exportacao(valores.get(col)) for col in colunas]
+        if ao_processar and numero % TAMANHO_LOTE_STREAMING == 0:
+            ao_processar(numero)
+
+def formatar_valor_exportacao(valor):
+    return valor.strftime('%d/%m/%Y') if isinstance(valor, (datetime.datetime, datetime.date)) else valor
+
+def escrever_xlsx(destino, colunas, linhas):
+    # constant_memory grava cada linha no disco assim que a próxima começa.
+    workbook = xlsxwriter.Workbook(destino, {'constant_memory': True})
+    try:
+        planilha = workbook.add_worksheet('Cadastros')
+        planilha.write_row(0, 0, colunas, workbook.add_format({'bold': True, 'border': 1}))
+        for numero_linha, linha in enumerate(linhas, start=1):
+            planilha.write_row(numero_linha, 0, linha)
+    finally:
+        workbook.close()
+
+def gerar_csv(colunas, linhas):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')  # BOM para o Excel reconhecer UTF-8
+    writer.writerow(colunas)
+    for linha in linhas:
+        writer.writerow(linha)
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0); buffer.truncate()
+    yield buffer.getvalue()
+
+
+# ------------------ CACHE DE RESPOSTAS (ETAG + CORPOS PRÉ-COMPRIMIDOS) ------------------
+class CacheRespostas:
+    """
+    Guarda por worker o corpo das listagens grandes já comprimido, indexado pela URL
+    e validado por um ETag derivado das versões das tabelas de que a resposta depende.
+    Uma consulta repetida sem alterações custa só a leitura dessas versões: responde
+    304 se o cliente já tem o ETag, ou o corpo pronto, sem serializar nada.
+    """
+    _lock = threading.Lock()
+    _entradas = OrderedDict()  # chave -> (etag, mimetype, {codificação: corpo})
+    _tamanho = 0
+
+    @classmethod
+    def obter(cls, chave, etag):
+        with cls._lock:
+            entrada = cls._entradas.get(chave)
+            if entrada is None or entrada[0] != etag: return None
+            cls._entradas.move_to_end(chave)
+            return entrada
+
+    @classmethod
+    def guardar(cls, chave, etag, mimetype, corpo):
+        corpos = {'identity': corpo, 'gzip': gzip.compress(corpo, compresslevel=6), 'br': brotli.compress(corpo, quality=5)}
+        tamanho = sum(len(c) for c in corpos.values())
+        limite = app.config['RESPOSTAS_CACHE_MAX_MB'] * 1024 * 1024
+        with cls._lock:
+            anterior = cls._entradas.pop(chave, None)
+            if anterior: cls._tamanho -= sum(len(c) for c in anterior[2].values())
+            if tamanho <= limite:
+                cls._entradas[chave] = (etag, mimetype, corpos)
+                cls._tamanho += tamanho
+            while cls._tamanho > limite:
+                _, (_, _, removidos) = cls._entradas.popitem(last=False)
+                cls._tamanho -= sum(len(c) for c in removidos.values())
+        return etag, mimetype, corpos
+
+    @classmethod
+    def limpar(cls):
+        with cls._lock:
+            cls._entradas.clear()
+            cls._tamanho = 0
+
+    @staticmethod
+    def responder(entrada):
+        etag, mimetype, corpos = entrada
+        codificacao = next((c for c in ('br', 'gzip') if request.accept_encodings[c]), 'identity')
+        response = app.response_class(corpos[codificacao], mimetype=mimetype)
+        if codificacao != 'identity': response.content_encoding = codificacao
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True  # O cliente sempre revalida (If-None-Match)
+        response.vary.update(('Accept-Encoding', 'Authorization'))
+        return response
+
+def resposta_em_cache(*versoes):
+    """
+    Decorador das listagens: 304/corpo em cache enquanto as versões informadas não mudam.
+    Deve vir depois de @token_required. Respostas NDJSON não passam pelo cache.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if request.method != 'GET' or deseja_streaming():
+                return f(*args, **kwargs)
+            chave = request.full_path
+            etag = hashlib.sha1(f'{chave}|{obter_versoes(versoes)}'.encode()).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+            entrada = CacheRespostas.obter(chave, etag)
+            if entrada is None:
+                response = app.make_response(f(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                entrada = CacheRespostas.guardar(chave, etag, response.mimetype, response.get_data())
+            return CacheRespostas.responder(entrada)
+        return decorated
+    return decorator
+
+
+# ------------------ RESPOSTAS EM STREAMING (NDJSON) ------------------
+OPCOES_ORJSON = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+TAMANHO_LOTE_STREAMING = 500
+
+def deseja_streaming():
+    return request.args.get('formato') == 'ndjson' or 'application/x-ndjson' in request.headers.get('Accept', '')
+
+def resposta_ndjson(linhas):
+    # Uma linha JSON por registro, gerada sob demanda: a memória não cresce com o tamanho da tabela.
+    def gerar():
+        for linha in linhas:
+            yield orjson.dumps(linha, option=OPCOES_ORJSON) + b'\n'
+    return app.response_class(stream_with_context(gerar()), mimetype='application/x-ndjson')
+
+
 # ------------------ CORS PRE-FLIGHT HANDLER ------------------
 @app.before_request
 def handle_preflight_cors():
@@ -306,6 +1473,135 @@ def add_cors_headers(response):
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
     return response
 
+# ------------------ INSTRUMENTAÇÃO (SERVER-TIMING E /metrics) ------------------
+class MetricasRequisicoes:
+    """
+    Agrega, por rota, histogramas de latência e totais de SQL e serialização no
+    formato de exposição do Prometheus. Os valores são por processo (cada worker
+    do gunicorn expõe os seus).
+    """
+    LIMITES_HISTOGRAMA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    _lock = threading.Lock()
+    _rotas = {}
+
+    @classmethod
+    def registrar(cls, metodo, rota, duracao, consultas, tempo_sql, tempo_serializacao, excedeu_limite):
+        with cls._lock:
+            dados = cls._rotas.setdefault((metodo, rota), {
+                'buckets': [0] * len(cls.LIMITES_HISTOGRAMA), 'soma': 0.0, 'contagem': 0,
+                'sql_consultas': 0, 'sql_segundos': 0.0, 'serializacao_segundos': 0.0, 'excesso_consultas': 0})
+            for indice, limite in enumerate(cls.LIMITES_HISTOGRAMA):
+                if duracao <= limite: dados['buckets'][indice] += 1
+            dados['soma'] += duracao
+            dados['contagem'] += 1
+            dados['sql_consultas'] += consultas
+            dados['sql_segundos'] += tempo_sql
+            dados['serializacao_segundos'] += tempo_serializacao
+            dados['excesso_consultas'] += int(excedeu_limite)
+
+    @classmethod
+    def exportar(cls):
+        with cls._lock:
+            rotas = {chave: dict(dados, buckets=list(dados['buckets'])) for chave, dados in cls._rotas.items()}
+        linhas = [
+            '# HELP reurb_http_request_duration_seconds Latência das requisições por rota.',
+            '# TYPE reurb_http_request_duration_seconds histogram',
+        ]
+        for (metodo, rota), dados in sorted(rotas.items()):
+            rotulos = f'method="{metodo}",route="{rota}"'
+            for limite, quantidade in zip(cls.LIMITES_HISTOGRAMA, dados['buckets']):
+                linhas.append(f'reurb_http_request_duration_seconds_bucket{{{rotulos},le="{limite}"}} {quantidade}')
+            linhas.append(f'reurb_http_request_duration_seconds_bucket{{{rotulos},le="+Inf"}} {dados["contagem"]}')
+            linhas.append(f'reurb_http_request_duration_seconds_sum{{{rotulos}}} {dados["soma"]}')
+            linhas.append(f'reurb_http_request_duration_seconds_count{{{rotulos}}} {dados["contagem"]}')
+        for nome, chave, descricao in (
+            ('reurb_sql_queries_total', 'sql_consultas', 'Consultas SQL executadas.'),
+            ('reurb_sql_duration_seconds_total', 'sql_segundos', 'Tempo gasto em consultas SQL.'),
+            ('reurb_serialization_duration_seconds_total', 'serializacao_segundos', 'Tempo gasto gerando JSON.'),
+            ('reurb_requests_query_threshold_exceeded_total', 'excesso_consultas', 'Requisições acima do limite de consultas SQL.'),
+        ):
+            linhas += [f'# HELP {nome} {descricao}', f'# TYPE {nome} counter']
+            linhas += [f'{nome}{{method="{metodo}",route="{rota}"}} {dados[chave]}' for (metodo, rota), dados in sorted(rotas.items())]
+        return '\n'.join(linhas) + '\n'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def iniciar_medicao_sql(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('inicio_consultas', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finalizar_medicao_sql(conn, cursor, statement, parameters, context, executemany):
+    duracao = time.perf_counter() - conn.info['inicio_consultas'].pop()
+    if has_request_context() and 'metricas_inicio' in g:
+        g.sql_consultas += 1
+        g.sql_tempo += duracao
+
+
+class JSONProviderInstrumentado(DefaultJSONProvider):
+    """
+    Codifica as respostas com orjson (datas, UUIDs e tipos do numpy direto, sem passar
+    por isoformat/default em Python) e soma o tempo gasto nas métricas da requisição.
+    """
+    def codificar(self, obj, indent=None, sort_keys=None):
+        inicio = time.perf_counter()
+        try:
+            opcoes = OPCOES_ORJSON
+            if self.sort_keys if sort_keys is None else sort_keys: opcoes |= orjson.OPT_SORT_KEYS
+            if indent: opcoes |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=self.default, option=opcoes)
+        finally:
+            if has_request_context() and 'metricas_inicio' in g:
+                g.tempo_serializacao += time.perf_counter() - inicio
+
+    def dumps(self, obj, **kwargs):
+        return self.codificar(obj, kwargs.get('indent'), kwargs.get('sort_keys')).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = None if self.compact or (self.compact is None and not self._app.debug) else 2
+        return self._app.response_class(self.codificar(obj, indent) + b'\n', mimetype=self.mimetype)
+
+app.json = JSONProviderInstrumentado(app)
+
+
+@app.before_request
+def iniciar_metricas_requisicao():
+    g.metricas_inicio = time.perf_counter()
+    g.sql_consultas, g.sql_tempo, g.tempo_serializacao = 0, 0.0, 0.0
+
+@app.after_request
+def registrar_metricas_requisicao(response):
+    if 'metricas_inicio' not in g or request.endpoint == 'metricas':
+        return response
+    duracao = time.perf_counter() - g.metricas_inicio
+    rota = request.url_rule.rule if request.url_rule else 'desconhecida'
+    excedeu_limite = g.sql_consultas > app.config['METRICAS_LIMITE_CONSULTAS']
+    if excedeu_limite:
+        app.logger.warning(f"{request.method} {rota}: {g.sql_consultas} consultas SQL (limite {app.config['METRICAS_LIMITE_CONSULTAS']}), possível N+1")
+    MetricasRequisicoes.registrar(request.method, rota, duracao, g.sql_consultas, g.sql_tempo, g.tempo_serializacao, excedeu_limite)
+    response.headers['Server-Timing'] = (
+        f'sql;dur={g.sql_tempo * 1000:.1f};desc="{g.sql_consultas} consultas", '
+        f'json;dur={g.tempo_serializacao * 1000:.1f}, total;dur={duracao * 1000:.1f}')
+    response.headers['Timing-Allow-Origin'] = '*'
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metricas():
+    token = app.config['METRICAS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return jsonify({'mensagem': 'Token de métricas inválido!'}), 401
+    return app.response_class(MetricasRequisicoes.exportar(), mimetype='text/plain; version=0.0.4')
+
+@app.errorhandler(ServicoSenhasOcupado)
+def servico_senhas_ocupado(e):
+    response = jsonify({'mensagem': 'Servidor ocupado. Tente novamente em instantes.'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '2'
+    return response
+
 # ------------------------------------------------------------
 
 def token_required(f):
@@ -321,7 +1617,7 @@ def token_required(f):
         if not token: return jsonify({'mensagem': 'Token de autenticação ausente!'}), 401
         try:
             data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            current_user = Usuario.query.filter_by(id=data['public_id']).first()
+            current_user = CacheUsuarios.obter(data['public_id'])
             if not current_user: return jsonify({'mensagem': 'Usuário do token não encontrado!'}), 401
         except jwt.ExpiredSignatureError: return jsonify({'mensagem': 'Token expirado!'}), 401
         except jwt.InvalidTokenError: return jsonify({'mensagem': 'Token inválido!'}), 401
@@ -347,14 +1643,21 @@ def login():
     if request.method == 'OPTIONS': return jsonify({'status': 'ok'}), 200
     data = request.get_json()
     if not data or not data.get('usuario') or not data.get('senha'): return jsonify({'mensagem': 'Não foi possível verificar'}), 401
+    espera = ControleTentativasLogin.segundos_bloqueado(data['usuario'])
+    if espera:
+        response = jsonify({'mensagem': 'Muitas tentativas de login. Aguarde e tente novamente.'})
+        response.headers['Retry-After'] = str(espera)
+        return response, 429
     user = Usuario.query.filter_by(usuario=data['usuario']).first()
     if not user: return jsonify({'mensagem': 'Usuário não encontrado.'}), 401
     if user.verificar_senha(data['senha']):
+        ControleTentativasLogin.limpar(data['usuario'])
         token = jwt.encode({
             'public_id': user.id, 'usuario': user.usuario, 'acesso': user.acesso,
             'exp': datetime.datetime.utcnow() + datetime.timedelta(days=1)
         }, app.config['SECRET_KEY'], algorithm="HS256")
         return jsonify({'mensagem': 'Login bem-sucedido!', 'token': token, 'nome_usuario': user.nome, 'acesso': user.acesso})
+    ControleTentativasLogin.registrar_falha(data['usuario'])
     return jsonify({'mensagem': 'Login ou senha incorretos.'}), 401
     
 @app.route('/api/redefinir-senha', methods=['POST'])
@@ -362,10 +1665,14 @@ def redefinir_senha():
     data = request.get_json()
     usuario_str, senha_atual, senha_nova = data.get('usuario'), data.get('senha_atual'), data.get('senha_nova')
     if not all([usuario_str, senha_atual, senha_nova]): return jsonify({'erro': 'Todos os campos são obrigatórios'}), 400
+    if ControleTentativasLogin.segundos_bloqueado(usuario_str): return jsonify({'erro': 'Muitas tentativas. Aguarde e tente novamente.'}), 429
     user = Usuario.query.filter_by(usuario=usuario_str).first()
-    if not user or not user.verificar_senha(senha_atual): return jsonify({'erro': 'Usuário ou senha atual incorreta'}), 401
-    user.senha_hash = generate_password_hash(senha_nova, method="scrypt")
+    if not user or not user.verificar_senha(senha_atual):
+        ControleTentativasLogin.registrar_falha(usuario_str)
+        return jsonify({'erro': 'Usuário ou senha atual incorreta'}), 401
+    user.senha_hash = ServicoSenhas.gerar_hash(senha_nova)
     db.session.commit()
+    CacheUsuarios.invalidar(user.id)
     return jsonify({'sucesso': True, 'mensagem': 'Senha redefinida com sucesso!'})
 
 
@@ -444,38 +1751,57 @@ def cadastrar_reurb(current_user):
         return jsonify({'mensagem': f'Erro ao criar cadastro: {str(e)}'}), 400
 
 
+def ordenar_por_iptu(query, decrescente, cursor):
+    """Ordena por (iptu, id), acrescenta o iptu ao fim da consulta e aplica o cursor "iptu:id"."""
+    colunas = (CadastroReurb.iptu, CadastroReurb.id)
+    query = query.add_columns(CadastroReurb.iptu).order_by(*[coluna.desc() if decrescente else coluna.asc() for coluna in colunas])
+    if not cursor: return query
+    valor, _, cadastro_id = cursor.rpartition(':')
+    valor, cadastro_id = to_float(valor), to_int(cadastro_id)
+    if valor is None or cadastro_id is None: raise ValueError('Cursor inválido.')
+    if decrescente:
+        return query.filter(or_(CadastroReurb.iptu < valor, and_(CadastroReurb.iptu == valor, CadastroReurb.id < cadastro_id)))
+    return query.filter(or_(CadastroReurb.iptu > valor, and_(CadastroReurb.iptu == valor, CadastroReurb.id > cadastro_id)))
+
 @app.route('/api/cadastros', methods=['GET'])
 @token_required
+@resposta_em_cache('cadastros')
 def get_cadastros(current_user):
-    cadastros = CadastroReurb.query.options(joinedload(CadastroReurb.construcoes)).order_by(CadastroReurb.id.desc()).all()
-    output = []
-    
-    for c in cadastros:
-        cadastro_data = {col.name: getattr(c, col.name) for col in c.__table__.columns if col.name not in ['imovel_estrutura', 'imovel_cobertura', 'imovel_instalacao_sanitaria', 'imovel_forro', 'imovel_piso', 'imovel_portas', 'imovel_janelas', 'imovel_revestimento']}
-
-        valores = CalculoTributarioService.calcular_valores(c)
-        renda, outro_imovel = c.reurb_renda_familiar or 0, c.reurb_outro_imovel or ''
-        tipo_reurb = 'REURB-S' if renda <= 7500 and outro_imovel.lower() == 'nao' else 'REURB-E'
-
-        cadastro_data['tipo_reurb'] = tipo_reurb
-        cadastro_data.update(valores)
-
-        total_area_construida = 0
-        construcoes_list = []
-        for construcao in c.construcoes:
-            total_area_construida += construcao.area_construida or 0
-            construcoes_list.append({col.name: getattr(construcao, col.name) for col in construcao.__table__.columns})
-        
-        cadastro_data['construcoes'] = construcoes_list
-        cadastro_data['imovel_area_construida'] = total_area_construida
-
-        for key, value in cadastro_data.items():
-            if isinstance(value, (datetime.datetime, datetime.date)):
-                cadastro_data[key] = value.isoformat()
-
-        output.append(cadastro_data)
-        
-    return jsonify({'cadastros': output})
+    # Parâmetros opcionais: filtros (status, bairro, tipo_reurb, inscricao, criado_de/ate,
+    # atualizado_de/ate, iptu_min/max), fields=, ordem (iptu ou -iptu; padrão: mais recentes)
+    # e paginação por cursor (limite, cursor = último id recebido, ou "iptu:id" com ordem).
+    ordem = request.args.get('ordem')
+    try:
+        if ordem and ordem not in ('iptu', '-iptu'): raise ValueError('ordem deve ser "iptu" ou "-iptu".')
+        serializador = SerializadorCadastros.para(campos_do_parametro(request.args.get('fields')))
+        query = filtrar_cadastros(serializador.consulta(), request.args)
+        limite = to_int(request.args.get('limite'))
+        if ordem:
+            query = ordenar_por_iptu(query, ordem == '-iptu', request.args.get('cursor'))
+        else:
+            query, cursor = query.order_by(CadastroReurb.id.desc()), to_int(request.args.get('cursor'))
+            if cursor: query = query.filter(CadastroReurb.id < cursor)
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    if deseja_streaming():
+        if limite: query = query.limit(limite)
+        return resposta_ndjson(serializador.em_lotes(query))
+    if limite:
+        limite = max(1, min(limite, LIMITE_MAXIMO_PAGINA))
+        cadastros = query.limit(limite + 1).all()
+        tem_mais = len(cadastros) > limite
+        cadastros = cadastros[:limite]
+    else:
+        cadastros = query.all()
+
+    output = serializador.serializar(cadastros)
+    if not limite:
+        return jsonify({'cadastros': output})
+    proximo_cursor = None
+    if tem_mais:
+        # Com ordem, a consulta traz o iptu como última coluna
+        proximo_cursor = f'{cadastros[-1][-1]!r}:{output[-1]["id"]}' if ordem else output[-1]['id']
+    return jsonify({'cadastros': output, 'proximo_cursor': proximo_cursor})
 
 # ===== NOVA ROTA: BUSCAR CADASTRO POR INSCRIÇÃO =====
 @app.route('/api/cadastros/por_inscricao/<inscricao_imobiliaria>', methods=['GET'])
@@ -492,65 +1818,444 @@ def get_cadastro_por_inscricao(current_user, inscricao_imobiliaria):
         'inscricao_imobiliaria': cadastro.inscricao_imobiliaria
     })
 
-@app.route('/api/cadastros/<int:id>', methods=['GET', 'PUT', 'DELETE'])
+# ------------------- EDIÇÃO DE CADASTROS (PUT/PATCH COM IF-MATCH) -------------------
+CAMPOS_FLOAT_CADASTRO = {'latitude', 'longitude', 'imovel_medida_frente', 'imovel_medida_fundo', 'imovel_medida_ld', 'imovel_medida_le', 'imovel_area_total', 'reurb_renda_familiar'}
+CAMPOS_NAO_EDITAVEIS_CADASTRO = {'id', 'data_criacao', 'data_atualizacao', 'texto_busca', 'seq_alteracao', 'chave_idempotencia', *CAMPOS_CALCULADOS_CADASTRO}
+CAMPOS_CONSTRUCAO = [col for col in Construcao.__table__.columns.keys() if col not in ('id', 'cadastro_id')]
+
+class PreCondicaoFalhou(Exception):
+    pass
+
+def etag_cadastro(cadastro):
+    # data_atualizacao muda a cada edição (inclusive só de construções) e serve como versão do cadastro
+    versao = cadastro.data_atualizacao.strftime('%Y%m%d%H%M%S%f') if cadastro.data_atualizacao else '0'
+    return f'{cadastro.id}-{versao}'
+
+def aplicar_campos_cadastro(cadastro, data):
+    # Retorna True se algum campo mudou
+    alterou = False
+    for key, value in data.items():
+        if key not in CadastroReurb.__table__.columns or key in CAMPOS_NAO_EDITAVEIS_CADASTRO: continue
+        if key in CAMPOS_FLOAT_CADASTRO: value = to_float(value)
+        elif key == 'imovel_num_habitantes': value = to_int(value)
+        if getattr(cadastro, key) != value:
+            setattr(cadastro, key, value)
+            alterou = True
+    return alterou
+
+def sincronizar_construcoes(cadastro, construcoes_data, parcial):
+    """
+    Aplica a lista de construções por diferença: itens com id existente são
+    atualizados (só os campos enviados, se parcial), itens sem id são inseridos e
+    as construções ausentes da lista são excluídas. Retorna True se algo mudou.
+    """
+    existentes = {construcao.id: construcao for construcao in cadastro.construcoes}
+    mantidas, alterou = set(), False
+    for const_data in construcoes_data:
+        construcao = existentes.get(const_data.get('id'))
+        if construcao is None:
+            if parcial and const_data.get('id') is not None:
+                raise ValueError(f"Construção {const_data.get('id')} não pertence a este cadastro.")
+            if not const_data.get('nome'):
+                raise ValueError('O nome da construção é obrigatório.')
+            valores = {campo: const_data.get(campo) for campo in CAMPOS_CONSTRUCAO}
+            valores['area_construida'] = to_float(valores['area_construida'])
+            cadastro.construcoes.append(Construcao(**valores))
+            alterou = True
+            continue
+        mantidas.add(construcao.id)
+        for campo in CAMPOS_CONSTRUCAO:
+            if parcial and campo not in const_data: continue
+            valor = to_float(const_data.get(campo)) if campo == 'area_construida' else const_data.get(campo)
+            if getattr(construcao, campo) != valor:
+                setattr(construcao, campo, valor)
+                alterou = True
+    for construcao_id, construcao in existentes.items():
+        if construcao_id not in mantidas:
+            # Exclusão explícita, além do delete-orphan: assim a construção está em session.deleted
+            # no before_flush e recebe o registro de exclusão da sincronização
+            cadastro.construcoes.remove(construcao)
+            db.session.delete(construcao)
+            alterou = True
+    return alterou
+
+def registrar_edicao_cadastro(cadastro, exigir_versao):
+    """
+    Avança data_atualizacao com um UPDATE condicionado à versão lida, antes do flush
+    das alterações: a linha fica bloqueada até o commit e, com If-Match, uma
+    edição concorrente entre a leitura e a gravação resulta em PreCondicaoFalhou.
+    Deve ser chamada com o autoflush desligado, depois de aplicar as alterações em memória.
+    """
+    tabela, agora = CadastroReurb.__table__, datetime.datetime.utcnow()
+    condicao = tabela.c.id == cadastro.id
+    if exigir_versao: condicao = and_(condicao, tabela.c.data_atualizacao == cadastro.data_atualizacao)
+    seq = incrementar_versao('cadastros')
+    if not db.session.execute(tabela.update().where(condicao).values(data_atualizacao=agora, seq_alteracao=seq)).rowcount:
+        raise PreCondicaoFalhou()
+    set_committed_value(cadastro, 'data_atualizacao', agora)
+    set_committed_value(cadastro, 'seq_alteracao', seq)
+
+@app.route('/api/cadastros/<int:id>', methods=['GET', 'PUT', 'PATCH', 'DELETE'])
 @token_required
 def gerenciar_cadastro_por_id(current_user, id):
-    cadastro = CadastroReurb.query.options(joinedload(CadastroReurb.documentos), joinedload(CadastroReurb.construcoes)).get_or_404(id)
-    
     if request.method == 'GET':
-        cadastro_data = {key: getattr(cadastro, key) for key in CadastroReurb.__table__.columns.keys()}
-        cadastro_data['documentos'] = [{'id': d.id, 'nome_arquivo': d.nome_arquivo, 'tipo_documento': d.tipo_documento} for d in cadastro.documentos]
-        cadastro_data['construcoes'] = [{col.name: getattr(construcao, col.name) for col in construcao.__table__.columns} for construcao in cadastro.construcoes]
-        for key, value in cadastro_data.items():
-            if isinstance(value, (datetime.datetime, datetime.date)):
-                cadastro_data[key] = value.isoformat()
-        return jsonify(cadastro_data)
+        # Leitura direto em tuplas do Core; o ORM só é usado para alterar
+        linha = db.session.query(*[CadastroReurb.__table__.c[coluna] for coluna in COLUNAS_PUBLICAS_CADASTRO]).filter(CadastroReurb.id == id).first_or_404()
+        cadastro_data = linha._asdict()
+        cadastro_data['documentos'] = [linha_documento._asdict() for linha_documento in db.session.query(
+            Documento.id, Documento.nome_arquivo, Documento.tipo_documento).filter(Documento.cadastro_id == id).order_by(Documento.id)]
+        cadastro_data['construcoes'] = [dict(zip(COLUNAS_CONSTRUCAO, construcao)) for construcao in db.session.query(
+            Construcao.__table__).filter(Construcao.cadastro_id == id).order_by(Construcao.id)]
+        response = jsonify(cadastro_data)
+        response.set_etag(etag_cadastro(linha))
+        return response.make_conditional(request)
 
-    if request.method == 'PUT':
-        data = request.get_json()
-        for key, value in data.items():
-            if hasattr(cadastro, key) and key not in ['id', 'construcoes', 'documentos']:
-                if key in ['latitude', 'longitude', 'imovel_medida_frente', 'imovel_medida_fundo', 'imovel_medida_ld', 'imovel_medida_le', 'imovel_area_total', 'reurb_renda_familiar']:
-                    setattr(cadastro, key, to_float(value))
-                elif key == 'imovel_num_habitantes':
-                    setattr(cadastro, key, to_int(value))
-                else:
-                    setattr(cadastro, key, value)
-        
-        Construcao.query.filter_by(cadastro_id=id).delete()
-        
-        construcoes_data = data.get('construcoes', [])
-        for const_data in construcoes_data:
-            nova_construcao = Construcao(
-                cadastro_id=id,
-                nome=const_data.get('nome'),
-                area_construida=to_float(const_data.get('area_construida')),
-                uso_principal=const_data.get('uso_principal'),
-                padrao_construtivo=const_data.get('padrao_construtivo'),
-                tipo_imovel=const_data.get('tipo_imovel'),
-                estrutura=const_data.get('estrutura'),
-                cobertura=const_data.get('cobertura'),
-                instalacao_sanitaria=const_data.get('instalacao_sanitaria'),
-                forro=const_data.get('forro'),
-                piso=const_data.get('piso'),
-                portas=const_data.get('portas'),
-                janelas=const_data.get('janelas'),
-                revestimento=const_data.get('revestimento')
-            )
-            db.session.add(nova_construcao)
+    cadastro = CadastroReurb.query.options(joinedload(CadastroReurb.documentos), joinedload(CadastroReurb.construcoes)).get_or_404(id)
 
-        db.session.commit()
-        return jsonify({'mensagem': 'Cadastro atualizado com sucesso!'})
+    if request.method in ('PUT', 'PATCH'):
+        # PUT substitui o cadastro (construções ausentes são excluídas); PATCH altera só o que foi enviado
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict): return jsonify({'erro': 'Envie um objeto JSON.'}), 400
+        if request.if_match and not request.if_match.contains(etag_cadastro(cadastro)):
+            return jsonify({'erro': 'O cadastro foi alterado por outro usuário. Recarregue e tente novamente.'}), 412
+        parcial = request.method == 'PATCH'
+        try:
+            # Sem autoflush, as alterações só vão ao banco depois do UPDATE condicionado à versão.
+            # Uma edição que não muda nada não avança data_atualizacao, ETag nem seq_alteracao.
+            with db.session.no_autoflush:
+                alterou = aplicar_campos_cadastro(cadastro, data)
+                if not parcial or 'construcoes' in data:
+                    alterou = sincronizar_construcoes(cadastro, data.get('construcoes') or [], parcial) or alterou
+                if alterou: registrar_edicao_cadastro(cadastro, exigir_versao=bool(request.if_match))
+            db.session.commit()
+        except ValueError as e:
+            db.session.rollback()
+            return jsonify({'erro': str(e)}), 400
+        except PreCondicaoFalhou:
+            db.session.rollback()
+            return jsonify({'erro': 'O cadastro foi alterado por outro usuário. Recarregue e tente novamente.'}), 412
+        response = jsonify({'mensagem': 'Cadastro atualizado com sucesso!'})
+        response.set_etag(etag_cadastro(cadastro))
+        return response
 
     if request.method == 'DELETE':
-        for doc in cadastro.documentos:
-            if os.path.exists(doc.path_arquivo):
-                os.remove(doc.path_arquivo)
-        
+        # Arquivos antigos são removidos em segundo plano; os blobs, pelo coletar-arquivos periódico
+        coleta = ArmazenamentoArquivos.liberar(cadastro.documentos)
         db.session.delete(cadastro)
         db.session.commit()
+        if coleta: TarefaService.submeter('coleta_arquivos', coleta, current_user.id)
         return jsonify({'mensagem': 'Cadastro deletado com sucesso!'})
 
+# ------------------- CADASTRO EM LOTE (SINCRONIZAÇÃO DOS APLICATIVOS) -------------------
+LIMITE_CADASTROS_POR_LOTE = 1000
+# Mesmos campos aceitos por /api/cadastrar_reurb (o status fica com o valor padrão)
+CAMPOS_CRIACAO_CADASTRO = [col for col in CadastroReurb.__table__.columns.keys() if col not in CAMPOS_NAO_EDITAVEIS_CADASTRO | {'status'}]
+CAMPOS_CRIACAO_CONSTRUCAO = [col for col in Construcao.__table__.columns.keys() if col not in ('id', 'cadastro_id')]
+
+def preparar_item_lote(item):
+    """Valida um cadastro do lote; retorna (dados, construcoes, erros)."""
+    if not isinstance(item, dict): return None, [], ['O item deve ser um objeto JSON.']
+    dados, erros = converter_linha_importacao(item, ignoradas=CAMPOS_NAO_EDITAVEIS_CADASTRO | {'status'})
+    construcoes = []
+    for numero, const_data in enumerate(item.get('construcoes') or [], start=1):
+        if not isinstance(const_data, dict):
+            erros.append(f'Construção {numero}: deve ser um objeto JSON.')
+            continue
+        construcao, erros_construcao = converter_linha_importacao(const_data, Construcao.__table__, {'id', 'cadastro_id'})
+        if not construcao.get('nome'): erros_construcao.append('o nome é obrigatório')
+        erros += [f'Construção {numero}: {erro}' for erro in erros_construcao]
+        construcoes.append({campo: construcao.get(campo) for campo in CAMPOS_CRIACAO_CONSTRUCAO})
+    return {campo: dados.get(campo) for campo in CAMPOS_CRIACAO_CADASTRO}, construcoes, erros
+
+def gravar_lote_cadastros(preparados, resultados):
+    """
+    Insere um lote (lista de (indice, chave, dados, construcoes)) numa transação: um
+    INSERT em massa dos cadastros com RETURNING dos ids e outro das construções.
+    Chaves já gravadas devolvem o cadastro existente.
+    """
+    chaves = [chave for _, chave, _, _ in preparados if chave]
+    existentes = dict(db.session.query(CadastroReurb.chave_idempotencia, CadastroReurb.id)
+                      .filter(CadastroReurb.chave_idempotencia.in_(chaves))) if chaves else {}
+    novos = [item for item in preparados if item[1] not in existentes]
+    for indice, chave, _, _ in preparados:
+        if chave in existentes: resultados[indice].update(situacao='existente', id=existentes[chave])
+    if not novos: return
+    try:
+        agora, seq = datetime.datetime.utcnow(), incrementar_versao('cadastros')
+        ids = db.session.scalars(insert(CadastroReurb).returning(CadastroReurb.id, sort_by_parameter_order=True), [
+            dict(dados, chave_idempotencia=chave, texto_busca=montar_texto_busca(dados),
+                 data_criacao=agora, data_atualizacao=agora, seq_alteracao=seq)
+            for _, chave, dados, _ in novos]).all()
+        construcoes = [dict(construcao, cadastro_id=cadastro_id)
+                       for cadastro_id, (_, _, _, itens) in zip(ids, novos) for construcao in itens]
+        if construcoes: db.session.execute(insert(Construcao), construcoes)
+        CalculoTributarioService.recalcular(CadastroReurb.id.in_(ids), agora, seq)
+        ResumoCadastrosService.aplicar(Counter(ResumoCadastrosService.chave(ResumoCadastrosService.valores_novos(dados)) for _, _, dados, _ in novos))
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        if len(novos) > 1:
+            # Outro envio concorrente gravou alguma das chaves: refaz item a item
+            for item in novos: gravar_lote_cadastros([item], resultados)
+            return
+        resultados[novos[0][0]].update(situacao='erro', erros=[f'Erro de integridade: {e.orig}'])
+        return
+    for cadastro_id, (indice, _, _, _) in zip(ids, novos):
+        resultados[indice].update(situacao='criado', id=cadastro_id)
+
+@app.route('/api/cadastros/lote', methods=['POST'])
+@token_required
+def cadastrar_reurb_em_lote(current_user):
+    """
+    Recebe {"cadastros": [...]} (ou a lista diretamente), cada item no formato de
+    /api/cadastrar_reurb com uma "chave_idempotencia" opcional. Responde com o
+    resultado de cada item, na ordem enviada: criado, existente (chave repetida) ou erro.
+    """
+    data = request.get_json(silent=True)
+    itens = data.get('cadastros') if isinstance(data, dict) else data
+    if not isinstance(itens, list) or not itens: return jsonify({'erro': 'Envie uma lista de cadastros.'}), 400
+    if len(itens) > LIMITE_CADASTROS_POR_LOTE:
+        return jsonify({'erro': f'No máximo {LIMITE_CADASTROS_POR_LOTE} cadastros por requisição.'}), 400
+
+    resultados, preparados, primeiro_por_chave = [], [], {}
+    for indice, item in enumerate(itens):
+        chave = item.get('chave_idempotencia') if isinstance(item, dict) else None
+        chave = str(chave).strip()[:100] if chave else None
+        resultados.append({'indice': indice, 'chave_idempotencia': chave})
+        dados, construcoes, erros = preparar_item_lote(item)
+        if erros:
+            resultados[indice].update(situacao='erro', erros=erros)
+        elif chave in primeiro_por_chave:
+            continue  # Repetido no próprio lote: recebe o resultado do primeiro
+        else:
+            if chave: primeiro_por_chave[chave] = indice
+            preparados.append((indice, chave, dados, construcoes))
+
+    for inicio in range(0, len(preparados), TAMANHO_LOTE_IMPORTACAO):
+        gravar_lote_cadastros(preparados[inicio:inicio + TAMANHO_LOTE_IMPORTACAO], resultados)
+    for resultado in resultados:
+        if 'situacao' not in resultado:
+            primeiro = resultados[primeiro_por_chave[resultado['chave_idempotencia']]]
+            resultado.update(situacao='existente' if primeiro['situacao'] != 'erro' else 'erro',
+                             **{k: v for k, v in primeiro.items() if k in ('id', 'erros')})
+
+    resumo = {situacao: sum(1 for r in resultados if r['situacao'] == situacao) for situacao in ('criado', 'existente', 'erro')}
+    return jsonify({'resultados': resultados, 'resumo': resumo})
+
+# ------------------- SINCRONIZAÇÃO INCREMENTAL (CLIENTES OFFLINE) -------------------
+LIMITE_PADRAO_SINCRONIZACAO = 200
+COLUNAS_SINCRONIZACAO = [col for col in CadastroReurb.__table__.columns.keys() if col != 'texto_busca']
+
+def ler_cursor_sincronizacao(cursor):
+    # Cursor "seq.id_cadastro.id_exclusao": tudo até esse ponto já foi entregue ao cliente
+    if not cursor: return 0, 0, 0
+    partes = cursor.split('.')
+    if len(partes) != 3 or not all(parte.isdigit() for parte in partes):
+        raise ValueError('Cursor inválido.')
+    return tuple(int(parte) for parte in partes)
+
+def serializar_sincronizacao(c):
+    dados = {col: getattr(c, col) for col in COLUNAS_SINCRONIZACAO}
+    for key, value in dados.items():
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            dados[key] = value.isoformat()
+    dados['construcoes'] = [{col: getattr(construcao, col) for col in Construcao.__table__.columns.keys()} for construcao in c.construcoes]
+    dados['documentos'] = [{'id': d.id, 'nome_arquivo': d.nome_arquivo, 'tipo_documento': d.tipo_documento, 'sha256': d.sha256} for d in c.documentos]
+    return dados
+
+@app.route('/api/sincronizacao', methods=['GET'])
+@token_required
+def sincronizar_cadastros(current_user):
+    """
+    Alterações desde o cursor, em ordem de commit: cadastros criados/alterados (com
+    construções e documentos) e exclusões. Sem cursor, entrega a base completa em páginas.
+    O cliente repete com o cursor devolvido enquanto tem_mais for verdadeiro.
+    """
+    try:
+        seq, cadastro_id, exclusao_id = ler_cursor_sincronizacao(request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    # A versão é lida antes dos dados: tudo até ela já está commitado e aparece nas consultas abaixo
+    versao_atual, exclusoes_removidas = obter_versoes(('cadastros', 'exclusoes_removidas'))
+    if seq and seq <= exclusoes_removidas:
+        return jsonify({'erro': 'Cursor expirado: as exclusões desse período já foram descartadas. Faça a sincronização completa.'}), 410
+    limite = max(1, min(to_int(request.args.get('limite')) or LIMITE_PADRAO_SINCRONIZACAO, LIMITE_MAXIMO_PAGINA))
+
+    cadastros = CadastroReurb.query.options(selectinload(CadastroReurb.construcoes), selectinload(CadastroReurb.documentos)).filter(
+        (CadastroReurb.seq_alteracao > seq) | and_(CadastroReurb.seq_alteracao == seq, CadastroReurb.id > cadastro_id)
+    ).order_by(CadastroReurb.seq_alteracao, CadastroReurb.id).limit(limite + 1).all()
+    exclusoes = Exclusao.query.filter(
+        (Exclusao.seq_alteracao > seq) | and_(Exclusao.seq_alteracao == seq, Exclusao.id > exclusao_id)
+    ).order_by(Exclusao.seq_alteracao, Exclusao.id).limit(limite + 1).all()
+
+    # Junta as duas listas na ordem (seq, cadastros antes de exclusões, id) e corta na página
+    itens = sorted([(c.seq_alteracao, 0, c.id, c) for c in cadastros] + [(e.seq_alteracao, 1, e.id, e) for e in exclusoes],
+                   key=lambda item: item[:3])
+    tem_mais, itens = len(itens) > limite, itens[:limite]
+    alteracoes, excluidos = [], []
+    for seq_item, tipo, item_id, item in itens:
+        if seq_item != seq: seq, cadastro_id, exclusao_id = seq_item, 0, 0
+        if tipo == 0:
+            alteracoes.append(serializar_sincronizacao(item))
+            cadastro_id = item_id
+        else:
+            excluidos.append({'tabela': item.tabela, 'id': item.registro_id, 'cadastro_id': item.cadastro_id})
+            exclusao_id = item_id
+    if not tem_mais and versao_atual > seq:
+        seq, cadastro_id, exclusao_id = versao_atual, 0, 0  # Nada entre o último item e a versão atual
+    return jsonify({'alteracoes': alteracoes, 'exclusoes': excluidos,
+                    'cursor': f'{seq}.{cadastro_id}.{exclusao_id}', 'tem_mais': tem_mais})
+
+# ------------------- BUSCA TEXTUAL -------------------
+LIMITE_RESULTADOS_BUSCA = 50
+
+def reindexar_busca(ids=None):
+    """Recalcula texto_busca (de todos os cadastros ou dos ids informados). Não faz commit."""
+    query = db.session.query(CadastroReurb.id, *[getattr(CadastroReurb, campo) for campo in CAMPOS_BUSCA])
+    if ids is not None:
+        query = query.filter(CadastroReurb.id.in_(ids))
+    atualizacoes = [{'id': linha[0], 'texto_busca': montar_texto_busca(dict(zip(CAMPOS_BUSCA, linha[1:])))} for linha in query]
+    for inicio in range(0, len(atualizacoes), TAMANHO_LOTE_IMPORTACAO):
+        db.session.bulk_update_mappings(CadastroReurb, atualizacoes[inicio:inicio + TAMANHO_LOTE_IMPORTACAO])
+    if atualizacoes: incrementar_versao('cadastros')
+    return len(atualizacoes)
+
+def termos_busca(q):
+    termos = normalizar_busca(q).split()
+    digitos = re.sub(r'\D', '', q)
+    # "123.456.789-00" ou "01.002.0003": busca também pela sequência de dígitos
+    if len(digitos) >= 4 and re.fullmatch(r'[\d\s.\-/]+', q.strip()):
+        termos = [digitos]
+    return termos
+
+@app.route('/api/cadastros/busca', methods=['GET'])
+@token_required
+def buscar_cadastros(current_user):
+    q = (request.args.get('q') or '').strip()
+    limite = max(1, min(to_int(request.args.get('limite')) or 20, LIMITE_RESULTADOS_BUSCA))
+    termos = termos_busca(q)
+    if not termos or max(len(termo) for termo in termos) < 2:
+        return jsonify({'erro': 'Informe ao menos 2 caracteres para a busca.'}), 400
+    consulta = ' '.join(termos)
+
+    query = db.session.query(
+        CadastroReurb.id, CadastroReurb.req_nome, CadastroReurb.req_cpf, CadastroReurb.inscricao_imobiliaria,
+        CadastroReurb.imovel_logradouro, CadastroReurb.imovel_numero, CadastroReurb.imovel_bairro, CadastroReurb.texto_busca)
+    contem_todos = and_(*[CadastroReurb.texto_busca.contains(termo, autoescape=True) for termo in termos])
+
+    if db.engine.dialect.name == 'postgresql':
+        # pg_trgm: casa termos exatos ou aproximados (erros de digitação) e ordena por similaridade
+        similaridade = func.word_similarity(consulta, CadastroReurb.texto_busca)
+        linhas = query.add_columns(similaridade).filter(
+            contem_todos | db.literal(consulta).op('<%')(CadastroReurb.texto_busca)
+        ).order_by(similaridade.desc(), CadastroReurb.id.desc()).limit(limite).all()
+        resultados = [(float(linha[-1]), linha[:-1]) for linha in linhas]
+    else:
+        candidatos = query.filter(contem_todos).order_by(CadastroReurb.id.desc()).limit(LIMITE_RESULTADOS_BUSCA * 10).all()
+        resultados = sorted(
+            ((max(difflib.SequenceMatcher(None, consulta, palavra).ratio() for palavra in [linha[-1] or ''] + (linha[-1] or '').split()), linha)
+             for linha in candidatos), key=lambda item: -item[0])[:limite]
+
+    return jsonify({'resultados': [
+        {'id': linha[0], 'req_nome': linha[1], 'req_cpf': linha[2], 'inscricao_imobiliaria': linha[3],
+         'imovel_logradouro': linha[4], 'imovel_numero': linha[5], 'imovel_bairro': linha[6], 'pontuacao': round(pontuacao, 3)}
+        for pontuacao, linha in resultados
+    ]})
+
+# ------------------- MAPA (CONSULTAS ESPACIAIS) -------------------
+ZOOM_MINIMO_SEM_AGRUPAMENTO = 15
+LIMITE_PONTOS_MAPA = 5000
+METROS_POR_GRAU_LATITUDE = 111320.0
+
+def parse_bbox(valor):
+    # bbox=oeste,sul,leste,norte (mesma ordem do GeoJSON)
+    try:
+        oeste, sul, leste, norte = [float(parte) for parte in valor.split(',')]
+    except (AttributeError, ValueError):
+        raise ValueError('bbox deve ser "oeste,sul,leste,norte" em graus decimais.')
+    if sul > norte or oeste > leste:
+        raise ValueError('bbox inválido: sul/oeste devem ser menores que norte/leste.')
+    return oeste, sul, leste, norte
+
+def filtrar_por_bbox(query, oeste, sul, leste, norte):
+    return query.filter(CadastroReurb.latitude.between(sul, norte), CadastroReurb.longitude.between(oeste, leste))
+
+def feature_ponto(longitude, latitude, propriedades):
+    return {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [round(longitude, 6), round(latitude, 6)]}, 'properties': propriedades}
+
+def distancia_metros(lat1, lon1, lat2, lon2):
+    # Haversine
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi, dlambda = phi2 - phi1, math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+@app.route('/api/mapa/cadastros', methods=['GET'])
+@token_required
+def mapa_cadastros(current_user):
+    """
+    Pontos da área visível do mapa em GeoJSON. Abaixo de ZOOM_MINIMO_SEM_AGRUPAMENTO
+    os pontos são agrupados no banco numa grade proporcional ao zoom.
+    """
+    try:
+        oeste, sul, leste, norte = parse_bbox(request.args.get('bbox'))
+        query = filtrar_cadastros(CadastroReurb.query, request.args)
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    zoom = to_int(request.args.get('zoom'))
+    zoom = ZOOM_MINIMO_SEM_AGRUPAMENTO if zoom is None else max(0, min(zoom, 22))
+    query = filtrar_por_bbox(query, oeste, sul, leste, norte)
+
+    if zoom < ZOOM_MINIMO_SEM_AGRUPAMENTO:
+        # Célula de ~64px num mapa de blocos de 256px
+        tamanho_celula = 360.0 / (2 ** zoom) / 4
+        celula_lat = func.floor(CadastroReurb.latitude / tamanho_celula)
+        celula_lon = func.floor(CadastroReurb.longitude / tamanho_celula)
+        grupos = query.with_entities(
+            func.count(CadastroReurb.id), func.avg(CadastroReurb.latitude), func.avg(CadastroReurb.longitude), func.min(CadastroReurb.id)
+        ).group_by(celula_lat, celula_lon).all()
+        features = [
+            feature_ponto(longitude, latitude, {'quantidade': quantidade} if quantidade > 1 else {'id': primeiro_id})
+            for quantidade, latitude, longitude, primeiro_id in grupos
+        ]
+        return jsonify({'type': 'FeatureCollection', 'agrupado': True, 'features': features})
+
+    pontos = query.with_entities(
+        CadastroReurb.id, CadastroReurb.latitude, CadastroReurb.longitude, CadastroReurb.status, CadastroReurb.inscricao_imobiliaria
+    ).limit(LIMITE_PONTOS_MAPA + 1).all()
+    features = [
+        feature_ponto(longitude, latitude, {'id': cadastro_id, 'status': status, 'inscricao': inscricao})
+        for cadastro_id, latitude, longitude, status, inscricao in pontos[:LIMITE_PONTOS_MAPA]
+    ]
+    return jsonify({'type': 'FeatureCollection', 'agrupado': False, 'truncado': len(pontos) > LIMITE_PONTOS_MAPA, 'features': features})
+
+@app.route('/api/mapa/raio', methods=['GET'])
+@token_required
+def mapa_raio(current_user):
+    latitude, longitude = to_float(request.args.get('lat')), to_float(request.args.get('lon'))
+    raio = to_float(request.args.get('raio')) or 500.0  # metros
+    limite = max(1, min(to_int(request.args.get('limite')) or 100, LIMITE_PONTOS_MAPA))
+    if latitude is None or longitude is None:
+        return jsonify({'erro': 'Parâmetros lat e lon são obrigatórios.'}), 400
+
+    # Pré-filtro pelo retângulo que contém o círculo (usa o índice), depois a distância exata.
+    delta_lat = raio / METROS_POR_GRAU_LATITUDE
+    delta_lon = raio / (METROS_POR_GRAU_LATITUDE * max(math.cos(math.radians(latitude)), 0.01))
+    candidatos = filtrar_por_bbox(
+        db.session.query(CadastroReurb.id, CadastroReurb.latitude, CadastroReurb.longitude, CadastroReurb.status, CadastroReurb.inscricao_imobiliaria),
+        longitude - delta_lon, latitude - delta_lat, longitude + delta_lon, latitude + delta_lat).all()
+
+    proximos = sorted(
+        (distancia, cadastro_id, lat, lon, status, inscricao)
+        for cadastro_id, lat, lon, status, inscricao in candidatos
+        for distancia in [distancia_metros(latitude, longitude, lat, lon)] if distancia <= raio
+    )[:limite]
+    features = [
+        feature_ponto(lon, lat, {'id': cadastro_id, 'status': status, 'inscricao': inscricao, 'distancia_m': round(distancia, 1)})
+        for distancia, cadastro_id, lat, lon, status, inscricao in proximos
+    ]
+    return jsonify({'type': 'FeatureCollection', 'features': features})
+
 # ------------------- GERENCIAMENTO DE USUÁRIOS (ADMIN) -------------------
 @app.route('/api/usuarios', methods=['GET', 'POST'])
 @token_required
@@ -583,18 +2288,21 @@ def gerenciar_usuario_por_id(current_user, id):
         usuario.usuario = data.get('usuario', usuario.usuario)
         usuario.acesso = data.get('acesso', usuario.acesso)
         if 'senha' in data and data['senha']:
-            usuario.senha_hash = generate_password_hash(data['senha'], method="scrypt")
+            usuario.senha_hash = ServicoSenhas.gerar_hash(data['senha'])
         db.session.commit()
+        CacheUsuarios.invalidar(id)
         return jsonify({'mensagem': 'Usuário atualizado com sucesso!'})
     if request.method == 'DELETE':
         db.session.delete(usuario)
         db.session.commit()
+        CacheUsuarios.invalidar(id)
         return jsonify({'mensagem': 'Usuário deletado com sucesso!'})
 
 
 # ------------------- PLANTA GENÉRICA DE VALORES -------------------
 @app.route('/api/planta_generica/<tipo>', methods=['GET', 'POST'])
 @token_required
+@resposta_em_cache('pgv')
 def pgv_geral(current_user, tipo):
     model_map = {'padroes': PadraoConstrutivo, 'logradouros': ValorLogradouro, 'aliquotas': AliquotaIPTU}
     if tipo not in model_map: return jsonify({'erro': 'Tipo inválido'}), 404
@@ -605,13 +2313,14 @@ def pgv_geral(current_user, tipo):
         try:
             novo_item = Model(**data)
             db.session.add(novo_item)
+            PlantaGenericaCache.invalidar()
             db.session.commit()
             return jsonify({'sucesso': True, 'mensagem': f'{tipo.capitalize()} adicionado(a) com sucesso!'}), 201
         except Exception as e:
             db.session.rollback()
             return jsonify({'erro': f'Erro ao adicionar: {str(e)}'}), 400
-    items = Model.query.all()
-    items_dict = [ {c.name: getattr(item, c.name) for c in item.__table__.columns} for item in items ]
+    colunas = Model.__table__.columns.keys()
+    items_dict = [dict(zip(colunas, linha)) for linha in db.session.query(*Model.__table__.columns)]
     return jsonify(items_dict)
 
 @app.route('/api/planta_generica/<tipo>/<int:id>', methods=['DELETE'])
@@ -623,9 +2332,24 @@ def delete_pgv_item(current_user, tipo, id):
     Model = model_map[tipo]
     item = Model.query.get_or_404(id)
     db.session.delete(item)
+    PlantaGenericaCache.invalidar()
     db.session.commit()
     return jsonify({'sucesso': True, 'mensagem': 'Item deletado com sucesso!'})
 
+# ROTA PARA SIMULAR O IMPACTO DE ALTERAÇÕES NA PGV (NÃO GRAVA NADA)
+@app.route('/api/simulacao/iptu', methods=['POST'])
+@token_required
+def simular_pgv(current_user):
+    data = request.get_json() or {}
+    try:
+        resultado = SimulacaoIPTUService.simular(data)
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    except Exception as e:
+        app.logger.error(f"Erro na simulação da PGV: {str(e)}")
+        return jsonify({'erro': 'Erro interno ao simular a PGV.'}), 500
+    return jsonify(resultado)
+
 # =======================================================================
 # ===== NOVAS ROTAS PARA GERENCIAMENTO DE GUIAS IPTU E ESTATÍSTICAS =====
 # =======================================================================
@@ -657,9 +2381,8 @@ def emitir_guia(current_user):
     if guia_existente:
         return jsonify({'erro': f'Já existe uma guia emitida para o ano {ano_exercicio}.'}), 409
 
-    # Calcula o valor do IPTU
-    valores_tributarios = CalculoTributarioService.calcular_valores(cadastro)
-    valor_iptu = valores_tributarios.get('iptu', 0)
+    # Valor do IPTU gravado no cadastro (mantido por CalculoTributarioService)
+    valor_iptu = cadastro.iptu or 0
 
     if valor_iptu <= 0:
         return jsonify({'erro': 'O valor do IPTU calculado é zero ou negativo. Guia não emitida.'}), 400
@@ -672,10 +2395,83 @@ def emitir_guia(current_user):
         situacao='Em aberto'  # Status padrão
     )
     db.session.add(nova_guia)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Outra requisição emitiu a guia do mesmo ano entre a verificação e o commit
+        db.session.rollback()
+        return jsonify({'erro': f'Já existe uma guia emitida para o ano {ano_exercicio}.'}), 409
 
     return jsonify({'mensagem': 'Guia de IPTU emitida com sucesso!', 'guia': nova_guia.to_dict()}), 201
 
+def emitir_guias_em_lote(ano_exercicio, filtros=None):
+    """
+    Emite as guias do exercício para todos os cadastros elegíveis (ou os que
+    atendem aos filtros de listagem), com o IPTU já gravado em cada cadastro.
+    """
+    emitida = exists().where(GuiaIPTU.cadastro_id == CadastroReurb.id, GuiaIPTU.ano_exercicio == ano_exercicio)
+    base = db.session.query(CadastroReurb.id)
+    if filtros: base = filtrar_cadastros(base, filtros)
+    ja_existentes = base.filter(emitida).count()
+
+    # Anti-join: só os cadastros sem guia no exercício saem do banco.
+    query = db.session.query(CadastroReurb.id, CadastroReurb.iptu).filter(~emitida)
+    if filtros: query = filtrar_cadastros(query, filtros)
+    linhas = query.all()
+    ids = np.array([cadastro_id for cadastro_id, _ in linhas], dtype=np.int64)
+    iptu = np.array([valor or 0.0 for _, valor in linhas], dtype=float)
+    elegiveis = iptu > 0
+
+    agora = datetime.datetime.utcnow()
+    guias = [
+        {'cadastro_id': int(cadastro_id), 'ano_exercicio': ano_exercicio, 'valor_emitido': float(valor),
+         'data_emissao': agora, 'situacao': 'Em aberto'}
+        for cadastro_id, valor in zip(ids[elegiveis], iptu[elegiveis])
+    ]
+    for inicio in range(0, len(guias), TAMANHO_LOTE_IMPORTACAO):
+        db.session.bulk_insert_mappings(GuiaIPTU, guias[inicio:inicio + TAMANHO_LOTE_IMPORTACAO])
+    if guias: incrementar_versao('guias')
+    db.session.commit()
+
+    return {
+        'ano_exercicio': ano_exercicio,
+        'criadas': len(guias),
+        'ja_existentes': ja_existentes,
+        'valor_zero': int((~elegiveis).sum()),
+        'valor_total_emitido': float(iptu[elegiveis].sum()),
+    }
+
+@TarefaService.registrar('emissao_lote', admin=True)
+def tarefa_emissao_lote(tarefa_id, parametros, progresso):
+    return emitir_guias_em_lote(parametros['ano_exercicio'], parametros.get('filtros'))
+
+# ROTA PARA EMITIR AS GUIAS DE UM EXERCÍCIO INTEIRO
+@app.route('/api/guias/emitir_lote', methods=['POST'])
+@token_required
+@admin_required
+def emitir_lote(current_user):
+    data = request.get_json() or {}
+    ano_exercicio = to_int(data.get('ano_exercicio'))
+    filtros = data.get('filtros') or {}
+    if not ano_exercicio:
+        return jsonify({'erro': 'Ano de exercício é obrigatório.'}), 400
+    if not isinstance(filtros, dict):
+        return jsonify({'erro': 'filtros deve ser um objeto.'}), 400
+    try:
+        filtrar_cadastros(CadastroReurb.query, filtros)  # Valida os filtros antes de executar
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+
+    if data.get('assincrono'):
+        tarefa = TarefaService.submeter('emissao_lote', {'ano_exercicio': ano_exercicio, 'filtros': filtros}, current_user.id)
+        return jsonify({'mensagem': 'Emissão em lote iniciada.', 'tarefa': tarefa.to_dict()}), 202
+    try:
+        resultado = emitir_guias_em_lote(ano_exercicio, filtros)
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'erro': 'Guias foram emitidas por outra operação durante o lote. Tente novamente.'}), 409
+    return jsonify({'mensagem': f'{resultado["criadas"]} guia(s) emitida(s) para {ano_exercicio}.', **resultado}), 201
+
 # ROTA PARA ATUALIZAR A SITUAÇÃO DE UMA GUIA
 @app.route('/api/guias/atualizar_situacao/<int:guia_id>', methods=['PUT'])
 @token_required
@@ -731,6 +2527,7 @@ def excluir_guia(current_user, guia_id):
 # ROTA PARA LISTAR TODAS AS GUIAS PARA A TABELA GERAL
 @app.route('/api/guias/todas', methods=['GET'])
 @token_required
+@resposta_em_cache('guias', 'cadastros')
 def listar_todas_as_guias(current_user):
     try:
         # Junta GuiaIPTU com CadastroReurb para obter informações do proprietário
@@ -739,55 +2536,229 @@ def listar_todas_as_guias(current_user):
             CadastroReurb.req_nome,
             CadastroReurb.req_cpf,
             CadastroReurb.inscricao_imobiliaria
-        ).join(CadastroReurb, GuiaIPTU.cadastro_id == CadastroReurb.id).order_by(GuiaIPTU.id.desc()).all()
-
-        resultado = []
-        for guia, nome, cpf, inscricao in guias_com_info:
-            resultado.append({
-                'id_guia': guia.id,
-                'cadastro_id': guia.cadastro_id,
-                'ano_exercicio': guia.ano_exercicio,
-                'valor_emitido': guia.valor_emitido,
-                'data_emissao': guia.data_emissao.strftime('%d/%m/%Y %H:%M:%S'),
-                'situacao': guia.situacao,
-                'nome_proprietario': nome,
-                'cpf': cpf,
-                'inscricao_imobiliaria': inscricao
-            })
-            
+        ).join(CadastroReurb, GuiaIPTU.cadastro_id == CadastroReurb.id).order_by(GuiaIPTU.id.desc())
+
+        if deseja_streaming():
+            return resposta_ndjson(serializar_guia_com_proprietario(*linha) for linha in guias_com_info.yield_per(TAMANHO_LOTE_STREAMING))
+
+        resultado = [serializar_guia_com_proprietario(*linha) for linha in guias_com_info.all()]
         return jsonify(resultado)
 
     except Exception as e:
         app.logger.error(f"Erro ao buscar todas as guias: {str(e)}")
         return jsonify({'erro': 'Erro interno ao buscar as guias.'}), 500
+
+def serializar_guia_com_proprietario(guia, nome, cpf, inscricao):
+    return {
+        'id_guia': guia.id,
+        'cadastro_id': guia.cadastro_id,
+        'ano_exercicio': guia.ano_exercicio,
+        'valor_emitido': guia.valor_emitido,
+        'data_emissao': guia.data_emissao.strftime('%d/%m/%Y %H:%M:%S'),
+        'situacao': guia.situacao,
+        'nome_proprietario': nome,
+        'cpf': cpf,
+        'inscricao_imobiliaria': inscricao
+    }
 # =======================================================================
 # ===== FIM DA CORREÇÃO =================================================
 # =======================================================================
 
 # ROTA PARA AS ESTATÍSTICAS FINANCEIRAS DO DASHBOARD
+def novo_resumo_financeiro():
+    return {'quantidade': 0, 'quantidade_pagas': 0, 'valor_emitido': 0.0, 'valor_arrecadado': 0.0, 'valor_em_aberto': 0.0}
+
+def acumular_resumo_financeiro(resumo, situacao, quantidade, valor):
+    resumo['quantidade'] += quantidade
+    resumo['valor_emitido'] += valor
+    if situacao == 'Pago':
+        resumo['quantidade_pagas'] += quantidade
+        resumo['valor_arrecadado'] += valor
+    else:
+        resumo['valor_em_aberto'] += valor
+
+def finalizar_resumo_financeiro(resumo):
+    resumo['taxa_arrecadacao'] = (resumo['valor_arrecadado'] / resumo['valor_emitido']) if resumo['valor_emitido'] else 0.0
+    return resumo
+
+@app.route('/api/estatisticas/cadastros', methods=['GET'])
+@token_required
+@resposta_em_cache('cadastros')
+def get_estatisticas_cadastros(current_user):
+    # Lido de resumo_cadastros (poucas linhas), mantido a cada gravação de cadastro
+    return jsonify(ResumoCadastrosService.estatisticas())
+
+@app.route('/api/estatisticas/cadastros/reconstruir', methods=['POST'])
+@token_required
+@admin_required
+def reconstruir_estatisticas_cadastros(current_user):
+    ResumoCadastrosService.reconstruir()
+    db.session.commit()
+    return jsonify({'mensagem': 'Resumo dos cadastros reconstruído com sucesso!'})
+
 @app.route('/api/estatisticas/iptu', methods=['GET'])
 @token_required
+@resposta_em_cache('guias', 'cadastros')
 def get_estatisticas_iptu(current_user):
-    # Calcula o total arrecadado (soma dos valores das guias 'Pagas')
-    total_arrecadado_query = db.session.query(func.sum(GuiaIPTU.valor_emitido)).filter(GuiaIPTU.situacao == 'Pago').scalar()
-    total_arrecadado = total_arrecadado_query or 0.0
-
-    # Calcula o total em aberto (soma dos valores das guias 'Em aberto')
-    total_em_aberto_query = db.session.query(func.sum(GuiaIPTU.valor_emitido)).filter(GuiaIPTU.situacao == 'Em aberto').scalar()
-    total_em_aberto = total_em_aberto_query or 0.0
+    # Uma única consulta agrupada por exercício, situação e bairro; os demais recortes
+    # são somados em Python a partir desse resultado (poucas linhas).
+    query = db.session.query(
+        GuiaIPTU.ano_exercicio, GuiaIPTU.situacao, CadastroReurb.imovel_bairro,
+        func.count(GuiaIPTU.id), func.coalesce(func.sum(GuiaIPTU.valor_emitido), 0.0)
+    ).join(CadastroReurb, GuiaIPTU.cadastro_id == CadastroReurb.id)
+    ano_exercicio = to_int(request.args.get('ano_exercicio'))
+    if ano_exercicio:
+        query = query.filter(GuiaIPTU.ano_exercicio == ano_exercicio)
+    grupos = query.group_by(GuiaIPTU.ano_exercicio, GuiaIPTU.situacao, CadastroReurb.imovel_bairro).all()
+
+    totais, por_ano, por_bairro, por_situacao = novo_resumo_financeiro(), {}, {}, {}
+    for ano, situacao, bairro, quantidade, valor in grupos:
+        valor = float(valor)
+        acumular_resumo_financeiro(totais, situacao, quantidade, valor)
+        acumular_resumo_financeiro(por_ano.setdefault(ano, novo_resumo_financeiro()), situacao, quantidade, valor)
+        acumular_resumo_financeiro(por_bairro.setdefault(bairro or 'Sem bairro', novo_resumo_financeiro()), situacao, quantidade, valor)
+        resumo_situacao = por_situacao.setdefault(situacao, {'situacao': situacao, 'quantidade': 0, 'valor': 0.0})
+        resumo_situacao['quantidade'] += quantidade
+        resumo_situacao['valor'] += valor
 
     return jsonify({
-        'iptu_arrecadado': total_arrecadado,
-        'iptu_em_aberto': total_em_aberto
+        'iptu_arrecadado': totais['valor_arrecadado'],
+        'iptu_em_aberto': totais['valor_em_aberto'],
+        'totais': finalizar_resumo_financeiro(totais),
+        'por_ano': [dict(finalizar_resumo_financeiro(resumo), ano_exercicio=ano) for ano, resumo in sorted(por_ano.items(), reverse=True)],
+        'por_situacao': list(por_situacao.values()),
+        'por_bairro': [dict(finalizar_resumo_financeiro(resumo), bairro=bairro) for bairro, resumo in sorted(por_bairro.items())],
     })
 
 # ------------------- CÁLCULO E IMPORTAÇÃO/EXPORTAÇÃO -------------------
 @app.route('/api/gerar_iptu/<inscricao_imobiliaria>', methods=['GET'])
 @token_required
 def gerar_iptu(current_user, inscricao_imobiliaria):
-    cadastro = CadastroReurb.query.filter_by(inscricao_imobiliaria=inscricao_imobiliaria).first_or_404()
-    valores = CalculoTributarioService.calcular_valores(cadastro)
-    return jsonify(valores)
+    linha = db.session.query(CadastroReurb.vvt, CadastroReurb.vvc, CadastroReurb.vvi, CadastroReurb.iptu).filter(
+        CadastroReurb.inscricao_imobiliaria == inscricao_imobiliaria).first_or_404()
+    return jsonify(linha._asdict())
+
+# ------------------ IMPORTAÇÃO EM LOTES (UPSERT POR INSCRIÇÃO) ------------------
+TAMANHO_LOTE_IMPORTACAO = 1000
+COLUNAS_IGNORADAS_IMPORTACAO = {'id', 'data_criacao', 'data_atualizacao', 'seq_alteracao', 'chave_idempotencia', *CAMPOS_CALCULADOS_CADASTRO}
+MAPEAMENTO_COLUNAS_IMPORTACAO = {
+    'Nome do Requerente': 'req_nome', 'CPF do Requerente': 'req_cpf',
+    'Inscrição Imobiliária': 'inscricao_imobiliaria', 'Área Total do Lote (m²)': 'imovel_area_total',
+    'Renda Familiar (R$)': 'reurb_renda_familiar'}
+
+def ler_planilha_em_lotes(arquivo, nome_arquivo):
+    # Tudo é lido como texto (a inscrição "01.0010" não pode virar 1.001); a conversão é feita por coluna.
+    if nome_arquivo.endswith('.csv'):
+        lotes = pd.read_csv(arquivo, dtype=str, keep_default_na=False, chunksize=TAMANHO_LOTE_IMPORTACAO)
+    else:
+        df = pd.read_excel(arquivo, dtype=str)
+        lotes = (df.iloc[inicio:inicio + TAMANHO_LOTE_IMPORTACAO] for inicio in range(0, len(df), TAMANHO_LOTE_IMPORTACAO))
+    for lote in lotes:
+        yield lote.rename(columns=MAPEAMENTO_COLUNAS_IMPORTACAO).fillna('')
+
+def converter_linha_importacao(registro, tabela=CadastroReurb.__table__, ignoradas=COLUNAS_IGNORADAS_IMPORTACAO):
+    dados, erros = {}, []
+    for coluna, valor in registro.items():
+        if coluna in ignoradas or coluna not in tabela.columns:
+            continue
+        tipo = tabela.columns[coluna].type
+        valor = valor.strip() if isinstance(valor, str) else valor
+        if valor == '' or valor is None:
+            dados[coluna] = None
+        elif isinstance(tipo, (db.Float, db.Integer)):
+            convertido = to_float(valor) if isinstance(tipo, db.Float) else to_int(valor)
+            if convertido is None: erros.append(f'Valor numérico inválido em "{coluna}": {valor}')
+            dados[coluna] = convertido
+        else:
+            valor = str(valor)
+            if getattr(tipo, 'length', None) and len(valor) > tipo.length:
+                erros.append(f'"{coluna}" excede {tipo.length} caracteres')
+            dados[coluna] = valor
+    return dados, erros
+
+def gravar_lote_importacao(registros):
+    """Insere ou atualiza (pela inscrição imobiliária) um lote de registros e faz o commit."""
+    inscricoes = {dados['inscricao_imobiliaria'] for _, dados in registros if dados.get('inscricao_imobiliaria')}
+    existentes, valores_antigos = {}, {}
+    if inscricoes:
+        # Colunas do resumo do dashboard e da busca, para não reler os cadastros atualizados
+        colunas = list(dict.fromkeys(ResumoCadastrosService.COLUNAS + CAMPOS_BUSCA))
+        for inscricao, cadastro_id, *valores in db.session.query(CadastroReurb.inscricao_imobiliaria, CadastroReurb.id,
+                *[getattr(CadastroReurb, coluna) for coluna in colunas]).filter(CadastroReurb.inscricao_imobiliaria.in_(inscricoes)):
+            existentes[inscricao] = cadastro_id
+            valores_antigos[cadastro_id] = dict(zip(colunas, valores))
+    agora, seq = datetime.datetime.utcnow(), incrementar_versao('cadastros')
+    novos, novos_por_inscricao, atualizacoes = [], {}, {}
+    for _, dados in registros:
+        inscricao = dados.get('inscricao_imobiliaria')
+        if inscricao in existentes:
+            cadastro_id = existentes[inscricao]
+            atualizacoes.setdefault(cadastro_id, {'id': cadastro_id}).update(dados, data_atualizacao=agora, seq_alteracao=seq)
+        elif inscricao in novos_por_inscricao:
+            novos_por_inscricao[inscricao].update(dados)  # Linha repetida na planilha: a última prevalece
+        else:
+            novo = dict(dados, data_criacao=agora, data_atualizacao=agora, seq_alteracao=seq)
+            novos.append(novo)
+            if inscricao: novos_por_inscricao[inscricao] = novo
+    for novo in novos:
+        novo['texto_busca'] = montar_texto_busca(novo)
+    for cadastro_id, dados in atualizacoes.items():
+        dados['texto_busca'] = montar_texto_busca({**valores_antigos[cadastro_id], **dados})
+    if novos: db.session.bulk_insert_mappings(CadastroReurb, novos)
+    if atualizacoes: db.session.bulk_update_mappings(CadastroReurb, list(atualizacoes.values()))
+    # Valores tributários e tipo de REURB dos cadastros gravados neste lote (todos com a mesma seq)
+    CalculoTributarioService.recalcular(CadastroReurb.seq_alteracao == seq, agora, seq)
+    # Resumo do dashboard: +1 para os novos e, nas atualizações, troca da combinação antiga pela nova
+    deltas = Counter(ResumoCadastrosService.chave(ResumoCadastrosService.valores_novos(novo)) for novo in novos)
+    for cadastro_id, dados in atualizacoes.items():
+        antigos = valores_antigos[cadastro_id]
+        deltas[ResumoCadastrosService.chave(antigos)] -= 1
+        deltas[ResumoCadastrosService.chave({**antigos, **{k: v for k, v in dados.items() if k in antigos}})] += 1
+    ResumoCadastrosService.aplicar(deltas)
+    db.session.commit()
+    return len(novos), len(atualizacoes)
+
+def importar_planilha(arquivo, nome_arquivo, progresso=None):
+    """
+    Importa a planilha em lotes de TAMANHO_LOTE_IMPORTACAO linhas, cada um com seu
+    próprio commit. Linhas inválidas são ignoradas e listadas no relatório.
+    """
+    relatorio = {'total_linhas': 0, 'inseridos': 0, 'atualizados': 0, 'erros': []}
+    for lote in ler_planilha_em_lotes(arquivo, nome_arquivo):
+        registros = []
+        for indice, registro in zip(lote.index, lote.to_dict('records')):
+            linha = int(indice) + 2  # Linha na planilha (1 = cabeçalho)
+            dados, erros = converter_linha_importacao(registro)
+            if erros:
+                relatorio['erros'].append({'linha': linha, 'inscricao_imobiliaria': dados.get('inscricao_imobiliaria'), 'erro': '; '.join(erros)})
+            else:
+                registros.append((linha, dados))
+        relatorio['total_linhas'] += len(lote)
+        try:
+            inseridos, atualizados = gravar_lote_importacao(registros)
+        except Exception:
+            # Falha no lote: repete linha a linha para isolar os registros problemáticos.
+            db.session.rollback()
+            inseridos = atualizados = 0
+            for linha, dados in registros:
+                try:
+                    novo, atualizado = gravar_lote_importacao([(linha, dados)])
+                    inseridos, atualizados = inseridos + novo, atualizados + atualizado
+                except Exception as e:
+                    db.session.rollback()
+                    relatorio['erros'].append({'linha': linha, 'inscricao_imobiliaria': dados.get('inscricao_imobiliaria'), 'erro': str(getattr(e, 'orig', e))})
+        relatorio['inseridos'] += inseridos
+        relatorio['atualizados'] += atualizados
+        if progresso:
+            progresso(0, f"{relatorio['total_linhas']} linhas processadas")
+    return relatorio
+
+@TarefaService.registrar('importacao')
+def tarefa_importacao(tarefa_id, parametros, progresso):
+    try:
+        return importar_planilha(parametros['caminho'], parametros['nome_arquivo'], progresso)
+    finally:
+        if os.path.exists(parametros['caminho']): os.remove(parametros['caminho'])
 
 @app.route('/api/importar', methods=['POST'])
 @token_required
@@ -797,28 +2768,34 @@ def importar_dados(current_user):
     file = request.files['arquivo']
     if file.filename == '': return jsonify({'erro': 'Nome de arquivo vazio'}), 400
     if file:
+        if request.values.get('assincrono') in ('1', 'true'):
+            # O arquivo é salvo e processado por uma tarefa; a requisição retorna imediatamente.
+            caminho = TarefaService.caminho_resultado(f'entrada_{uuid.uuid4()}', os.path.splitext(file.filename)[1].lstrip('.') or 'dat')
+            file.save(caminho)
+            tarefa = TarefaService.submeter('importacao', {'caminho': caminho, 'nome_arquivo': file.filename}, current_user.id)
+            return jsonify({'mensagem': 'Importação iniciada.', 'tarefa': tarefa.to_dict()}), 202
         try:
-            df = pd.read_csv(file) if file.filename.endswith('.csv') else pd.read_excel(file)
-            column_mapping = {
-                'Nome do Requerente': 'req_nome', 'CPF do Requerente': 'req_cpf',
-                'Inscrição Imobiliária': 'inscricao_imobiliaria', 'Área Total do Lote (m²)': 'imovel_area_total',
-                'Renda Familiar (R$)': 'reurb_renda_familiar'}
-            df.rename(columns=column_mapping, inplace=True)
-            float_cols = ['imovel_area_total', 'reurb_renda_familiar', 'latitude', 'longitude']
-            for col in float_cols:
-                if col in df.columns: df[col] = pd.to_numeric(df[col], errors='coerce')
-            df = df.where(pd.notnull(df), None)
-            for _, row in df.iterrows():
-                valid_data = {k: v for k, v in row.to_dict().items() if k in CadastroReurb.__table__.columns.keys()}
-                db.session.add(CadastroReurb(**valid_data))
-            db.session.commit()
-            return jsonify({'mensagem': 'Dados importados com sucesso!'}), 200
+            relatorio = importar_planilha(file, file.filename)
+            return jsonify({'mensagem': 'Dados importados com sucesso!', **relatorio}), 200
         except Exception as e:
             db.session.rollback()
             return jsonify({'erro': f'Erro ao importar dados: {e}'}), 500
     return jsonify({'erro': 'Tipo de arquivo não suportado'}), 400
 
-# Em app.py, encontre a rota /api/exportar e substitua-a por esta:
+@TarefaService.registrar('exportacao')
+def tarefa_exportacao(tarefa_id, parametros, progresso):
+    colunas, formato = colunas_exportaveis(parametros.get('colunas') or []), parametros.get('formato', 'xlsx')
+    if formato not in FORMATOS_EXPORTACAO: raise ValueError(f'Formato inválido. Use: {", ".join(FORMATOS_EXPORTACAO)}.')
+    if not colunas: raise ValueError('Nenhuma coluna válida selecionada.')
+    total = db.session.query(func.count(CadastroReurb.id)).scalar() or 1
+    linhas = linhas_exportacao(colunas, ao_processar=lambda n: progresso(100.0 * n / total))
+    caminho = TarefaService.caminho_resultado(tarefa_id, formato)
+    if formato == 'csv':
+        with open(caminho, 'w', encoding='utf-8', newline='') as arquivo:
+            for trecho in gerar_csv(colunas, linhas): arquivo.write(trecho)
+    else:
+        escrever_xlsx(caminho, colunas, linhas)
+    return {'colunas': colunas, 'arquivo': (caminho, f'cadastros_reurb.{formato}')}
 
 @app.route('/api/exportar', methods=['POST'])
 @token_required
@@ -828,54 +2805,38 @@ def exportar_dados(current_user):
         colunas_selecionadas = data.get('colunas')
         if not colunas_selecionadas:
             return jsonify({'erro': 'Nenhuma coluna selecionada.'}), 400
+        formato = data.get('formato', 'xlsx')
+        if formato not in FORMATOS_EXPORTACAO:
+            return jsonify({'erro': f'Formato inválido. Use: {", ".join(FORMATOS_EXPORTACAO)}.'}), 400
 
-        # --- ALTERAÇÃO INICIA AQUI ---
-        # 1. Buscamos os cadastros da mesma forma que na rota principal, incluindo as construções.
-        cadastros_db = CadastroReurb.query.options(joinedload(CadastroReurb.construcoes)).all()
-        if not cadastros_db:
+        if not db.session.query(CadastroReurb.id).first():
             return jsonify({'erro': 'Não há dados para exportar.'}), 404
 
-        dados_para_exportar = []
-        for c in cadastros_db:
-            # 2. Criamos um dicionário base com os dados do banco
-            cadastro_data = {col.name: getattr(c, col.name) for col in c.__table__.columns}
-
-            # 3. Calculamos os mesmos campos dinâmicos da rota /api/cadastros
-            valores = CalculoTributarioService.calcular_valores(c)
-            renda = c.reurb_renda_familiar or 0
-            outro_imovel = c.reurb_outro_imovel or ''
-            tipo_reurb = 'REURB-S' if renda <= 7500 and outro_imovel.lower() == 'nao' else 'REURB-E'
+        if data.get('assincrono'):
+            tarefa = TarefaService.submeter('exportacao', {'colunas': colunas_selecionadas, 'formato': formato}, current_user.id)
+            return jsonify({'mensagem': 'Exportação iniciada.', 'tarefa': tarefa.to_dict()}), 202
 
-            cadastro_data['tipo_reurb'] = tipo_reurb
-            cadastro_data.update(valores) # Adiciona vvt, vvc, vvi, iptu
+        # Apenas as colunas pedidas (e as que os campos calculados exigem) são lidas do banco.
+        colunas = colunas_exportaveis(colunas_selecionadas)
+        if not colunas:
+            return jsonify({'erro': 'Nenhuma coluna válida selecionada.'}), 400
 
-            total_area_construida = sum(construcao.area_construida or 0 for construcao in c.construcoes)
-            cadastro_data['imovel_area_construida'] = total_area_construida
-            
-            # Formata datas para não dar erro no Excel
-            for key, value in cadastro_data.items():
-                if isinstance(value, (datetime.datetime, datetime.date)):
-                    cadastro_data[key] = value.strftime('%d/%m/%Y')
-            
-            dados_para_exportar.append(cadastro_data)
-        
-        # 4. Criamos o DataFrame com a lista completa de dados (incluindo os calculados)
-        df = pd.DataFrame(dados_para_exportar)
-        
-        # Garante que apenas colunas existentes no DataFrame sejam selecionadas
-        colunas_validas = [col for col in colunas_selecionadas if col in df.columns]
-        
-        df = df[colunas_validas]
-        # --- FIM DA ALTERAÇÃO ---
+        if formato == 'csv':
+            response = app.response_class(stream_with_context(gerar_csv(colunas, linhas_exportacao(colunas))), mimetype='text/csv')
+            response.headers['Content-Disposition'] = 'attachment; filename=cadastros_reurb.csv'
+            return response
 
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False, sheet_name='Cadastros')
-        output.seek(0)
-        
+        # Arquivo temporário anônimo: removido pelo sistema quando a resposta o fecha.
+        arquivo = tempfile.TemporaryFile(suffix='.xlsx')
+        try:
+            escrever_xlsx(arquivo, colunas, linhas_exportacao(colunas))
+            arquivo.seek(0)
+        except Exception:
+            arquivo.close()
+            raise
         return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheet.sheet',
+            arquivo,
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
             as_attachment=True,
             download_name='cadastros_reurb.xlsx'
         )
@@ -883,6 +2844,53 @@ def exportar_dados(current_user):
         app.logger.error(f"Erro ao exportar dados: {str(e)}")
         return jsonify({'erro': f'Erro inesperado: {e}'}), 500
 
+# ------------------- TAREFAS EM SEGUNDO PLANO -------------------
+@app.route('/api/tarefas', methods=['GET', 'POST'])
+@token_required
+def gerenciar_tarefas(current_user):
+    if request.method == 'POST':
+        data = request.get_json() or {}
+        if data.get('tipo') == 'importacao':
+            return jsonify({'erro': 'Use /api/importar com assincrono=1 para enviar o arquivo.'}), 400
+        if data.get('tipo') in TarefaService.internas:
+            return jsonify({'erro': f"Tipo de tarefa inválido: {data.get('tipo')}"}), 400
+        if data.get('tipo') in TarefaService.somente_admin and current_user.acesso != 'Administrador':
+            return jsonify({'erro': 'Acesso negado'}), 403
+        try:
+            tarefa = TarefaService.submeter(data.get('tipo'), data.get('parametros'), current_user.id)
+        except ValueError as e:
+            return jsonify({'erro': str(e)}), 400
+        return jsonify({'mensagem': 'Tarefa iniciada.', 'tarefa': tarefa.to_dict()}), 202
+    query = Tarefa.query
+    if current_user.acesso != 'Administrador':
+        query = query.filter_by(usuario_id=current_user.id)
+    tarefas = query.order_by(Tarefa.data_criacao.desc()).limit(100).all()
+    return jsonify([tarefa.to_dict() for tarefa in tarefas])
+
+def obter_tarefa_autorizada(current_user, tarefa_id):
+    tarefa = Tarefa.query.get_or_404(tarefa_id)
+    if current_user.acesso != 'Administrador' and tarefa.usuario_id != current_user.id:
+        return None
+    return tarefa
+
+@app.route('/api/tarefas/<tarefa_id>', methods=['GET'])
+@token_required
+def status_tarefa(current_user, tarefa_id):
+    tarefa = obter_tarefa_autorizada(current_user, tarefa_id)
+    if not tarefa: return jsonify({'erro': 'Acesso negado'}), 403
+    return jsonify(tarefa.to_dict())
+
+@app.route('/api/tarefas/<tarefa_id>/resultado', methods=['GET'])
+@token_required
+def baixar_resultado_tarefa(current_user, tarefa_id):
+    tarefa = obter_tarefa_autorizada(current_user, tarefa_id)
+    if not tarefa: return jsonify({'erro': 'Acesso negado'}), 403
+    if tarefa.status != 'Concluída' or not tarefa.caminho_arquivo:
+        return jsonify({'erro': 'A tarefa não possui resultado disponível.', 'status': tarefa.status}), 409
+    if not os.path.exists(tarefa.caminho_arquivo):
+        return jsonify({'erro': 'Arquivo de resultado não encontrado.'}), 410
+    return send_file(tarefa.caminho_arquivo, as_attachment=True, download_name=tarefa.nome_arquivo)
+
 # ------------------- UPLOAD DE DOCUMENTOS -------------------
 @app.route('/api/upload_documento/<int:id>', methods=['POST'])
 @token_required
@@ -894,15 +2902,21 @@ def upload_documento(current_user, id):
     if file:
         filename_base, file_extension = os.path.splitext(file.filename)
         timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        filename = secure_filename(f"{filename_base}_{timestamp}{file_extension}")
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        novo_documento = Documento(
-            cadastro_id=cadastro.id, nome_arquivo=filename, path_arquivo=filepath,
-            tipo_documento=request.form.get('tipo_documento', 'Não especificado'))
-        db.session.add(novo_documento)
-        db.session.commit()
-        return jsonify({'mensagem': 'Documento enviado com sucesso!', 'nome_arquivo': filename}), 201
+        # O sufixo aleatório evita que dois envios do mesmo nome no mesmo segundo compartilhem o nome público
+        filename = secure_filename(f"{filename_base}_{timestamp}_{uuid.uuid4().hex[:8]}{file_extension}")
+        try:
+            # O conteúdo é gravado uma única vez por hash; nome_arquivo continua sendo o nome público
+            sha256, _ = ArmazenamentoArquivos.salvar(file.stream)
+            novo_documento = Documento(
+                cadastro_id=cadastro.id, nome_arquivo=filename, path_arquivo=ArmazenamentoArquivos.caminho_blob(sha256),
+                sha256=sha256, tipo_documento=request.form.get('tipo_documento', 'Não especificado'))
+            db.session.add(novo_documento)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Erro ao salvar documento do cadastro {id}: {str(e)}")
+            return jsonify({'mensagem': 'Erro ao salvar o documento.'}), 500
+        return jsonify({'mensagem': 'Documento enviado com sucesso!', 'nome_arquivo': filename, 'sha256': sha256}), 201
 
 # =======================================================================
 # ===== CÓDIGO NOVO ADICIONADO AQUI =====================================
@@ -912,23 +2926,19 @@ def upload_documento(current_user, id):
 def deletar_documento(current_user, documento_id):
     """
     Exclui um documento específico pelo seu ID.
-    Remove o registro do banco de dados e o arquivo físico do servidor.
+    Remove o registro do banco de dados; o arquivo físico é apagado depois, pelo coletor (coletar-arquivos).
     """
     try:
         # Busca o documento no banco de dados. Se não encontrar, retorna 404.
         doc = Documento.query.get_or_404(documento_id)
         
-        filepath = doc.path_arquivo
-        
-        # Remove o registro do banco de dados
+        # Libera a referência ao conteúdo e remove o registro do banco de dados
+        coleta = ArmazenamentoArquivos.liberar([doc])
         db.session.delete(doc)
-        
-        # Tenta remover o arquivo físico do servidor
-        if filepath and os.path.exists(filepath):
-            os.remove(filepath)
             
         # Confirma as alterações no banco de dados
         db.session.commit()
+        if coleta: TarefaService.submeter('coleta_arquivos', coleta, current_user.id)
         
         return jsonify({'mensagem': 'Documento removido com sucesso!'})
 
@@ -941,9 +2951,235 @@ def deletar_documento(current_user, documento_id):
 # ===== FIM DO CÓDIGO ADICIONADO ========================================
 # =======================================================================
 
+CACHE_ARQUIVOS_IMUTAVEIS = 365 * 24 * 3600
+
+def enviar_blob(sha256, nome_download=None):
+    caminho = ArmazenamentoArquivos.caminho_blob(sha256)
+    if not os.path.exists(caminho):
+        return jsonify({'erro': 'Arquivo não encontrado.'}), 404
+    # conditional=True responde If-None-Match/If-Modified-Since (304) e Range (206)
+    response = send_file(caminho, download_name=nome_download or sha256, etag=sha256, conditional=True,
+                         max_age=CACHE_ARQUIVOS_IMUTAVEIS)
+    return cache_privado(response, imutavel=True)
+
+def cache_privado(response, imutavel=False):
+    # Documentos de identificação: só o navegador do usuário autenticado pode guardar a resposta,
+    # nunca proxies ou CDNs compartilhados.
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if imutavel: response.cache_control.immutable = True
+    return response
+
+def sha256_do_documento(filename):
+    # nome_arquivo não é único (documentos antigos podem repetir o nome): vale o envio mais recente
+    return db.session.query(Documento.sha256).filter(Documento.nome_arquivo == filename, Documento.sha256.isnot(None)).order_by(
+        Documento.id.desc()).limit(1).scalar()
+
 @app.route('/uploads/<path:filename>')
-def serve_upload(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+@token_required
+def serve_upload(current_user, filename):
+    if os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+        return cache_privado(send_from_directory(app.config['UPLOAD_FOLDER'], filename, max_age=3600))
+    # Documentos novos ficam no armazenamento por conteúdo; o nome público continua o mesmo
+    sha256 = sha256_do_documento(filename)
+    if not sha256:
+        return jsonify({'erro': 'Arquivo não encontrado.'}), 404
+    return enviar_blob(sha256, filename)
+
+@app.route('/imagens/<path:filename>')
+@token_required
+def servir_imagem_derivada(current_user, filename):
+    """
+    Miniatura de uma imagem enviada (foto da fachada ou documento).
+    Parâmetros: largura (uma de IMAGENS_LARGURAS) e formato (webp|jpeg); sem formato,
+    usa WebP quando o cliente o aceita.
+    """
+    largura = request.args.get('largura', type=int) or app.config['IMAGENS_LARGURAS'][0]
+    if largura not in app.config['IMAGENS_LARGURAS']:
+        return jsonify({'erro': f"Largura inválida. Use uma de: {', '.join(map(str, app.config['IMAGENS_LARGURAS']))}."}), 400
+    formato = request.args.get('formato')
+    if formato and formato not in ImagensDerivadas.FORMATOS:
+        return jsonify({'erro': 'Formato inválido. Use webp ou jpeg.'}), 400
+    negociado = not formato
+    if negociado: formato = 'webp' if request.accept_mimetypes['image/webp'] else 'jpeg'
+
+    # safe_join devolve None para caminhos que sairiam de UPLOAD_FOLDER (../, absolutos)
+    caminho, sha256 = safe_join(app.config['UPLOAD_FOLDER'], filename), None
+    if caminho is None:
+        return jsonify({'erro': 'Arquivo não encontrado.'}), 404
+    if not os.path.isfile(caminho):
+        sha256 = sha256_do_documento(filename)
+        caminho = ArmazenamentoArquivos.caminho_blob(sha256) if sha256 else None
+    if not caminho or not os.path.isfile(caminho):
+        return jsonify({'erro': 'Arquivo não encontrado.'}), 404
+
+    chave = ImagensDerivadas.chave_origem(caminho, sha256)
+    try:
+        destino = ImagensDerivadas.obter(caminho, chave, largura, formato)
+    except (OSError, Image.DecompressionBombError):
+        return jsonify({'erro': 'O arquivo não é uma imagem válida.'}), 415
+    response = send_file(destino, mimetype=ImagensDerivadas.FORMATOS[formato][1], etag=f'{chave}-{largura}-{formato}',
+                         conditional=True, max_age=CACHE_ARQUIVOS_IMUTAVEIS)
+    cache_privado(response, imutavel=True)
+    if negociado: response.vary.add('Accept')
+    return response
+
+@app.route('/arquivos/<sha256>')
+@token_required
+def servir_arquivo_por_hash(current_user, sha256):
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256):
+        return jsonify({'erro': 'Arquivo não encontrado.'}), 404
+    return enviar_blob(sha256)
+
+# =======================================================================
+# COMANDOS DE LINHA DE COMANDO (flask --app app <comando>)
+# =======================================================================
+@app.cli.command('benchmark-senha')
+@click.option('--metodo', default=None, help="Método do Werkzeug, ex.: 'scrypt:16384:8:1'. Padrão: SENHA_METODO.")
+@click.option('--repeticoes', default=5, show_default=True)
+def benchmark_senha(metodo, repeticoes):
+    """Mede o tempo de geração e verificação de hash de senha."""
+    metodo = metodo or app.config['SENHA_METODO']
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        senha_hash = generate_password_hash('senha-de-teste', metodo)
+    tempo_hash = (time.perf_counter() - inicio) / repeticoes
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        check_password_hash(senha_hash, 'senha-de-teste')
+    tempo_verificacao = (time.perf_counter() - inicio) / repeticoes
+    click.echo(f'{metodo}: hash {tempo_hash * 1000:.1f} ms, verificação {tempo_verificacao * 1000:.1f} ms '
+               f'(~{1 / tempo_verificacao:.1f} logins/s por processo)')
+
+@app.cli.command('coletar-arquivos')
+def coletar_arquivos_comando():
+    """Remove do disco os documentos que não são mais referenciados (agende periodicamente, ex.: cron a cada hora)."""
+    resultado = ArmazenamentoArquivos.coletar()
+    click.echo(f"{resultado['removidos']} arquivo(s) removido(s).")
+
+@app.cli.command('limpar-exclusoes')
+@click.option('--dias', default=90, show_default=True, help='Mantém os registros de exclusão mais recentes que isso.')
+def limpar_exclusoes_comando(dias):
+    """Descarta registros de exclusão antigos; cursores anteriores passam a exigir sincronização completa."""
+    corte = datetime.datetime.utcnow() - datetime.timedelta(days=dias)
+    limite_seq = db.session.query(func.max(Exclusao.seq_alteracao)).filter(Exclusao.data_exclusao < corte).scalar()
+    if not limite_seq:
+        click.echo('Nenhum registro de exclusão para descartar.')
+        return
+    removidos = Exclusao.query.filter(Exclusao.seq_alteracao <= limite_seq).delete(synchronize_session=False)
+    if not VersaoTabela.query.filter_by(nome='exclusoes_removidas').update({VersaoTabela.versao: limite_seq}):
+        db.session.add(VersaoTabela(nome='exclusoes_removidas', versao=limite_seq))
+    db.session.commit()
+    click.echo(f'{removidos} registro(s) de exclusão descartado(s).')
+
+@app.cli.command('reconstruir-resumo')
+def reconstruir_resumo_comando():
+    """Recalcula a tabela resumo_cadastros usada em /api/estatisticas/cadastros."""
+    ResumoCadastrosService.reconstruir()
+    db.session.commit()
+    click.echo(f"Resumo reconstruído: {ResumoCadastro.query.count()} combinação(ões).")
+
+def recalcular_todos_valores():
+    """Recalcula tipo_reurb, vvt, vvc, vvi e iptu de todos os cadastros e faz o commit; retorna quantos mudaram."""
+    seq = CalculoTributarioService.recalcular(CadastroReurb.id.isnot(None))
+    db.session.commit()
+    return CadastroReurb.query.filter_by(seq_alteracao=seq).count()
+
+@TarefaService.registrar('recalculo_valores', admin=True)
+def tarefa_recalculo_valores(tarefa_id, parametros, progresso):
+    return {'alterados': recalcular_todos_valores()}
+
+@app.cli.command('recalcular-valores')
+def recalcular_valores_comando():
+    """Recalcula tipo_reurb, vvt, vvc, vvi e iptu de todos os cadastros."""
+    click.echo(f'{recalcular_todos_valores()} cadastro(s) com valores alterados.')
+
+@app.cli.command('reindexar-busca')
+def reindexar_busca_comando():
+    """Preenche/recalcula o texto de busca de todos os cadastros."""
+    total = reindexar_busca()
+    db.session.commit()
+    click.echo(f'{total} cadastro(s) reindexado(s).')
+
+def consultas_auditadas():
+    """
+    Padrões de consulta emitidos pelas rotas, montados com valores reais do banco.
+    Cada item: (nome, consulta SQLAlchemy, dialeto exigido ou None).
+    """
+    cadastro = db.session.query(CadastroReurb.id, CadastroReurb.inscricao_imobiliaria, CadastroReurb.status,
+                                CadastroReurb.imovel_bairro, CadastroReurb.latitude, CadastroReurb.longitude
+                                ).order_by(CadastroReurb.id.desc()).first()
+    if not cadastro:
+        return []
+    cadastro_id, inscricao, status, bairro, latitude, longitude = cadastro
+    latitude, longitude = latitude or 0.0, longitude or 0.0
+    ano = db.session.query(func.max(GuiaIPTU.ano_exercicio)).scalar() or datetime.date.today().year
+    padrao = db.session.query(PadraoConstrutivo.descricao).first()
+    return [
+        ('cadastro por inscrição', CadastroReurb.query.filter_by(inscricao_imobiliaria=inscricao), None),
+        ('cadastro por id', CadastroReurb.query.filter_by(id=cadastro_id), None),
+        ('construções do cadastro', Construcao.query.filter_by(cadastro_id=cadastro_id), None),
+        ('documentos do cadastro', Documento.query.filter_by(cadastro_id=cadastro_id), None),
+        ('guias do cadastro', GuiaIPTU.query.filter_by(cadastro_id=cadastro_id).order_by(GuiaIPTU.ano_exercicio.desc()), None),
+        ('guia existente no exercício', GuiaIPTU.query.filter_by(cadastro_id=cadastro_id, ano_exercicio=ano), None),
+        ('guias do exercício', db.session.query(GuiaIPTU.cadastro_id).filter_by(ano_exercicio=ano), None),
+        ('guias por situação', GuiaIPTU.query.filter_by(situacao='Pago').order_by(GuiaIPTU.id.desc()).limit(100), None),
+        ('listagem por status (página)', CadastroReurb.query.filter_by(status=status).order_by(CadastroReurb.id.desc()).limit(100), None),
+        ('listagem por IPTU (página)', CadastroReurb.query.order_by(CadastroReurb.iptu.desc(), CadastroReurb.id.desc()).limit(100), None),
+        ('listagem por bairro (página)', CadastroReurb.query.filter_by(imovel_bairro=bairro).order_by(CadastroReurb.id.desc()).limit(100), None),
+        ('listagem por inscrição (prefixo)', filtrar_cadastros(CadastroReurb.query, {'inscricao': (inscricao or '')[:4]}).limit(100), 'postgresql'),
+        ('mapa por bbox', filtrar_por_bbox(db.session.query(CadastroReurb.id), longitude - 0.001, latitude - 0.001, longitude + 0.001, latitude + 0.001), None),
+        ('padrão construtivo por descrição', PadraoConstrutivo.query.filter_by(descricao=padrao[0] if padrao else ''), None),
+        ('usuário por login', Usuario.query.filter_by(usuario='admin'), None),
+    ]
+
+def varreduras_sequenciais(plano_sql):
+    """Tabelas lidas por varredura completa segundo o plano (PostgreSQL JSON ou SQLite)."""
+    if db.engine.dialect.name == 'postgresql':
+        tabelas, pendentes = [], [plano_sql[0][0][0]['Plan']]
+        while pendentes:
+            no = pendentes.pop()
+            if no.get('Node Type') == 'Seq Scan':
+                tabelas.append(no['Relation Name'])
+            pendentes.extend(no.get('Plans', []))
+        return tabelas
+    # SQLite: "SCAN tabela" sem índice (SEARCH ... USING INDEX é o caso bom)
+    return [linha[-1].split()[1] for linha in plano_sql if linha[-1].startswith('SCAN ') and 'INDEX' not in linha[-1]]
+
+def explicar(query):
+    sql = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    if db.engine.dialect.name == 'postgresql':
+        return db.session.execute(db.text(f'EXPLAIN (FORMAT JSON) {sql}')).fetchall()
+    return db.session.execute(db.text(f'EXPLAIN QUERY PLAN {sql}')).fetchall()
+
+@app.cli.command('auditar-consultas')
+@click.option('--min-linhas', default=1000, show_default=True, help='Tabelas com menos linhas podem ser varridas.')
+def auditar_consultas(min_linhas):
+    """Executa EXPLAIN nas consultas das rotas e falha se alguma varrer uma tabela grande."""
+    consultas = consultas_auditadas()
+    if not consultas:
+        click.echo('Banco sem cadastros: popule-o antes de auditar.')
+        sys.exit(2)
+    tamanhos = {}
+    falhas = 0
+    for nome, query, dialeto in consultas:
+        if dialeto and dialeto != db.engine.dialect.name:
+            click.echo(f'--     {nome}: verificada apenas em {dialeto}')
+            continue
+        varridas = []
+        for tabela in varreduras_sequenciais(explicar(query)):
+            if tabela not in tamanhos:
+                tamanhos[tabela] = db.session.execute(db.text(f'SELECT COUNT(*) FROM {tabela}')).scalar()
+            if tamanhos[tabela] >= min_linhas:
+                varridas.append(f'{tabela} ({tamanhos[tabela]} linhas)')
+        if varridas:
+            falhas += 1
+            click.echo(f'FALHA  {nome}: varredura sequencial em {", ".join(varridas)}')
+        else:
+            click.echo(f'ok     {nome}')
+    if falhas:
+        click.echo(f'{falhas} consulta(s) sem índice adequado.')
+        sys.exit(1)
 
 # =======================================================================
 # ROTA PARA SETUP INICIAL (USAR COM CUIDADO)
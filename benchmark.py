@@ -0,0 +1,225 @@
+# =======================================================================
+# CM REURB - Gerador de dados sintéticos e benchmarks dos caminhos críticos
+# =======================================================================
+# Uso:
+#   python benchmark.py                                  # SQLite temporário, 1k e 10k cadastros
+#   python benchmark.py --escalas 1000 10000 100000 --saida resultados.json
+#   python benchmark.py --banco postgresql://... --permitir-limpeza
+#
+# ATENÇÃO: o banco informado é APAGADO e recriado a cada escala.
+# =======================================================================
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BAIRROS = ['Centro', 'Jardim América', 'Vila Nova', 'São José', 'Bela Vista', 'Industrial', 'Santa Luzia',
+           'Boa Esperança', 'Alto da Serra', 'Ribeirinho', 'Nova Conquista', 'Parque das Águas']
+TIPOS_LOGRADOURO = ['Rua', 'Avenida', 'Travessa', 'Alameda']
+NOMES = ['Maria', 'José', 'Ana', 'João', 'Antônio', 'Francisca', 'Carlos', 'Paulo', 'Adriana', 'Lucas', 'Conceição', 'Raimundo']
+SOBRENOMES = ['Silva', 'Santos', 'Oliveira', 'Souza', 'Lima', 'Pereira', 'Araújo', 'Costa', 'Ribeiro', 'Gonçalves']
+PADROES = [('Baixo', 900.0), ('Popular', 1200.0), ('Normal', 1800.0), ('Alto', 2600.0)]
+USOS = [('Residencial', 0.008), ('Comercial', 0.015), ('Misto', 0.012), ('Industrial', 0.018)]
+
+
+def configurar_ambiente(url_banco):
+    # Precisa acontecer antes de importar o app, que lê a configuração no import.
+    os.environ['DATABASE_URL'] = url_banco
+    os.environ.setdefault('SENHA_POOL_WORKERS', '0')
+    os.environ.setdefault('TAREFAS_FOLDER', os.path.join(tempfile.gettempdir(), 'reurb_benchmark_tarefas'))
+    import app as aplicacao
+    return aplicacao
+
+
+def gerar_dados(aplicacao, quantidade, semente):
+    """Popula o banco com PGV, cadastros, construções e guias em distribuições plausíveis."""
+    db = aplicacao.db
+    rnd = random.Random(semente)
+    agora = datetime.datetime.utcnow()
+    logradouros = [f'{rnd.choice(TIPOS_LOGRADOURO)} {rnd.choice(NOMES)} {rnd.choice(SOBRENOMES)} {i}' for i in range(max(20, quantidade // 100))]
+
+    db.session.bulk_insert_mappings(aplicacao.ValorLogradouro, [
+        {'logradouro': nome, 'valor_m2': round(rnd.lognormvariate(5.0, 0.5), 2)} for nome in logradouros])
+    db.session.bulk_insert_mappings(aplicacao.PadraoConstrutivo, [{'descricao': d, 'valor_m2': v} for d, v in PADROES])
+    db.session.bulk_insert_mappings(aplicacao.AliquotaIPTU, [{'tipo': t, 'aliquota': a} for t, a in USOS])
+
+    lote = 5000
+    for inicio in range(0, quantidade, lote):
+        cadastros = []
+        for i in range(inicio, min(inicio + lote, quantidade)):
+            nome = f'{rnd.choice(NOMES)} {rnd.choice(SOBRENOMES)} {rnd.choice(SOBRENOMES)}'
+            cpf = f'{rnd.randint(0, 999):03d}.{rnd.randint(0, 999):03d}.{rnd.randint(0, 999):03d}-{rnd.randint(0, 99):02d}'
+            registro = {
+                'id': i + 1,
+                'status': rnd.choices(['Em Análise', 'Aprovado', 'Pendente', 'Indeferido'], [50, 35, 10, 5])[0],
+                'latitude': rnd.gauss(-1.455, 0.03), 'longitude': rnd.gauss(-48.49, 0.03),
+                'data_criacao': agora - datetime.timedelta(days=rnd.randint(0, 1500)), 'data_atualizacao': agora,
+                'req_nome': nome, 'req_cpf': cpf,
+                'conj_nome': f'{rnd.choice(NOMES)} {rnd.choice(SOBRENOMES)}' if rnd.random() < 0.4 else None,
+                'inscricao_imobiliaria': f'{rnd.randint(1, 9):02d}.{i // 1000:03d}.{i % 1000:04d}',
+                'imovel_logradouro': rnd.choice(logradouros) if rnd.random() < 0.95 else None,
+                'imovel_numero': str(rnd.randint(1, 2000)), 'imovel_bairro': rnd.choice(BAIRROS),
+                'imovel_cidade': 'Belém', 'imovel_uf': 'PA',
+                'imovel_area_total': round(rnd.lognormvariate(5.4, 0.6), 2) if rnd.random() < 0.97 else None,
+                'reurb_renda_familiar': round(rnd.lognormvariate(8.0, 0.8), 2),
+                'reurb_outro_imovel': rnd.choices(['nao', 'sim'], [85, 15])[0],
+                'risco_inundacao': rnd.choices(['Não', 'Sim'], [85, 15])[0],
+                'risco_deslizamento': rnd.choices(['Não', 'Sim'], [93, 7])[0],
+            }
+            registro['texto_busca'] = aplicacao.montar_texto_busca(registro)
+            cadastros.append(registro)
+        db.session.bulk_insert_mappings(aplicacao.CadastroReurb, cadastros)
+
+        construcoes, guias = [], []
+        for cadastro in cadastros:
+            for n in range(rnd.choices([0, 1, 2, 3], [10, 60, 22, 8])[0]):
+                construcoes.append({
+                    'cadastro_id': cadastro['id'], 'nome': f'Construção {n + 1}',
+                    'area_construida': round(rnd.lognormvariate(4.3, 0.5), 2),
+                    'uso_principal': rnd.choices([u for u, _ in USOS], [80, 12, 6, 2])[0],
+                    'padrao_construtivo': rnd.choices([p for p, _ in PADROES], [30, 40, 22, 8])[0],
+                })
+            for ano in (agora.year - 1, agora.year):
+                if rnd.random() < 0.7:
+                    guias.append({
+                        'cadastro_id': cadastro['id'], 'ano_exercicio': ano, 'valor_emitido': round(rnd.lognormvariate(5.5, 0.7), 2),
+                        'data_emissao': agora, 'situacao': rnd.choices(['Pago', 'Em aberto'], [60, 40])[0],
+                    })
+        db.session.bulk_insert_mappings(aplicacao.Construcao, construcoes)
+        db.session.bulk_insert_mappings(aplicacao.GuiaIPTU, guias)
+        db.session.commit()
+
+    # Inserções em massa não passam pelo flush: grava os valores tributários de uma vez, no fim
+    aplicacao.CalculoTributarioService.recalcular(aplicacao.CadastroReurb.id.isnot(None))
+    db.session.commit()
+
+
+def medir(funcao, repeticoes):
+    tempos, extra = [], {}
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        extra = funcao() or {}
+        tempos.append(time.perf_counter() - inicio)
+    return {'mediana_s': statistics.median(tempos), 'min_s': min(tempos), 'max_s': max(tempos), **extra}
+
+
+def casos_de_benchmark(aplicacao, cliente, cabecalhos):
+    db, CadastroReurb = aplicacao.db, aplicacao.CadastroReurb
+
+    def calcular_valores():
+        with aplicacao.app.test_request_context():
+            cadastros = CadastroReurb.query.options(aplicacao.selectinload(CadastroReurb.construcoes)).all()
+            for cadastro in cadastros:
+                aplicacao.CalculoTributarioService.calcular_valores(cadastro)
+            db.session.remove()
+        return {'linhas': len(cadastros)}
+
+    def calculo_vetorizado():
+        with aplicacao.app.test_request_context():
+            pgv = aplicacao.PlantaGenericaCache.obter()
+            cadastros, construcoes = aplicacao.SimulacaoIPTUService.carregar_base()
+            aplicacao.SimulacaoIPTUService.calcular(cadastros, construcoes, pgv.logradouros, pgv.padroes, pgv.aliquotas)
+        return {'linhas': len(cadastros)}
+
+    def serializacao():
+        with aplicacao.app.test_request_context():
+            serializador = aplicacao.SerializadorCadastros.para(None)
+            linhas = serializador.consulta().all()
+            inicio = time.perf_counter()
+            tamanho = len(aplicacao.app.json.codificar(serializador.serializar(linhas)))
+            tempo = time.perf_counter() - inicio
+            db.session.remove()
+        return {'linhas': len(linhas), 'bytes': tamanho, 'tempo_somente_serializacao_s': tempo}
+
+    def requisicao(metodo, url, cache=False, **kwargs):
+        # Sem cache=True, o cache de respostas é limpo antes de cada repetição (medição a frio)
+        def executar():
+            if not cache: aplicacao.CacheRespostas.limpar()
+            resposta = getattr(cliente, metodo)(url, headers=cabecalhos, **kwargs)
+            if resposta.status_code >= 400:
+                raise RuntimeError(f'{metodo.upper()} {url} -> {resposta.status_code}: {resposta.get_data(as_text=True)[:200]}')
+            tamanho = len(resposta.get_data())
+            resposta.close()  # Libera o arquivo temporário da exportação
+            return {'bytes': tamanho, 'status': resposta.status_code}
+        return executar
+
+    return [
+        ('calcular_valores (linha a linha)', calcular_valores),
+        ('calculo_vetorizado', calculo_vetorizado),
+        ('SerializadorCadastros + orjson', serializacao),
+        ('GET /api/cadastros', requisicao('get', '/api/cadastros')),
+        ('GET /api/cadastros (cache de respostas)', requisicao('get', '/api/cadastros', cache=True)),
+        ('GET /api/cadastros (página de 100, 5 campos)', requisicao('get', '/api/cadastros?limite=100&fields=req_nome,inscricao_imobiliaria,status,tipo_reurb,iptu')),
+        ('GET /api/cadastros (ndjson)', requisicao('get', '/api/cadastros?formato=ndjson')),
+        ('POST /api/exportar (xlsx)', requisicao('post', '/api/exportar', json={'colunas': ['inscricao_imobiliaria', 'req_nome', 'imovel_bairro', 'tipo_reurb', 'vvi', 'iptu']})),
+        ('POST /api/exportar (csv)', requisicao('post', '/api/exportar', json={'formato': 'csv', 'colunas': ['inscricao_imobiliaria', 'req_nome', 'imovel_bairro', 'tipo_reurb', 'vvi', 'iptu']})),
+        ('GET /api/guias/todas', requisicao('get', '/api/guias/todas')),
+        ('GET /api/guias/todas (cache de respostas)', requisicao('get', '/api/guias/todas', cache=True)),
+        ('GET /api/estatisticas/iptu', requisicao('get', '/api/estatisticas/iptu')),
+        ('GET /api/cadastros/busca', requisicao('get', '/api/cadastros/busca?q=maria%20silva')),
+        ('POST /api/simulacao/iptu', requisicao('post', '/api/simulacao/iptu', json={'logradouros': {'percentual': 10}})),
+    ]
+
+
+def executar(args):
+    if args.banco and not args.banco.startswith('sqlite') and not args.permitir_limpeza:
+        sys.exit('O banco informado será apagado. Use --permitir-limpeza para confirmar.')
+    url_banco = args.banco or f'sqlite:///{os.path.join(tempfile.gettempdir(), "reurb_benchmark.db")}'
+    aplicacao = configurar_ambiente(url_banco)
+    db = aplicacao.db
+
+    resultados = []
+    with aplicacao.app.app_context():
+        dialeto = db.engine.dialect.name
+        for escala in args.escalas:
+            db.drop_all()
+            db.create_all()
+            inicio = time.perf_counter()
+            gerar_dados(aplicacao, escala, args.semente)
+            print(f'[{escala}] dados gerados em {time.perf_counter() - inicio:.1f}s')
+
+            db.session.add(aplicacao.Usuario(nome='Benchmark', usuario='benchmark', senha='benchmark', acesso='Administrador'))
+            db.session.commit()
+            cliente = aplicacao.app.test_client()
+            token = cliente.post('/api/login', json={'usuario': 'benchmark', 'senha': 'benchmark'}).get_json()['token']
+            cabecalhos = {'Authorization': f'Bearer {token}'}
+
+            for nome, funcao in casos_de_benchmark(aplicacao, cliente, cabecalhos):
+                if args.filtro and args.filtro not in nome:
+                    continue
+                resultado = {'escala': escala, 'nome': nome, 'repeticoes': args.repeticoes, **medir(funcao, args.repeticoes)}
+                resultados.append(resultado)
+                print(f"[{escala}] {nome}: mediana {resultado['mediana_s'] * 1000:.1f} ms")
+        db.session.remove()
+        db.engine.dispose()
+
+    relatorio = {
+        'data': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'banco': dialeto,
+        'semente': args.semente,
+        'resultados': resultados,
+    }
+    with open(args.saida, 'w', encoding='utf-8') as arquivo:
+        json.dump(relatorio, arquivo, ensure_ascii=False, indent=2)
+    print(f'Resultados gravados em {args.saida}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks do CM REURB sobre dados sintéticos.')
+    parser.add_argument('--escalas', type=int, nargs='+', default=[1000, 10000], help='Quantidades de cadastros a gerar.')
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--banco', help='URL do banco (padrão: SQLite temporário). Será APAGADO.')
+    parser.add_argument('--permitir-limpeza', action='store_true', help='Confirma que o banco informado pode ser apagado.')
+    parser.add_argument('--filtro', help='Executa apenas os casos cujo nome contém este texto.')
+    parser.add_argument('--saida', default='benchmark_resultados.json')
+    executar(parser.parse_args())
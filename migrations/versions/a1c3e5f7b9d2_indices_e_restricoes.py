@@ -0,0 +1,138 @@
+"""Índices, restrições e tabelas auxiliares (cache da PGV, tarefas, busca)
+
+Aplica sobre um banco criado pelo /setup (db.create_all) as estruturas
+adicionadas ao modelo: tabelas versoes_tabelas e tarefas, coluna texto_busca,
+índices das chaves estrangeiras e filtros mais usados, índices de trigramas da
+busca e de prefixo da inscrição (PostgreSQL) e a restrição única de guias por
+(cadastro, exercício).
+
+Cada passo verifica se a estrutura já existe, para que a migração também possa
+ser aplicada a bancos criados depois dessas alterações.
+
+Após aplicar, preencha a busca dos cadastros existentes com:
+    flask --app app reindexar-busca
+
+Revision ID: a1c3e5f7b9d2
+Revises:
+Create Date: 2026-10-17 12:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f7b9d2'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+INDICES = [
+    ('ix_cadastros_reurb_status', 'cadastros_reurb', ['status']),
+    ('ix_cadastros_reurb_imovel_bairro', 'cadastros_reurb', ['imovel_bairro']),
+    ('ix_cadastros_reurb_lat_lon', 'cadastros_reurb', ['latitude', 'longitude']),
+    ('ix_construcoes_cadastro_id', 'construcoes', ['cadastro_id']),
+    ('ix_documentos_cadastro_id', 'documentos', ['cadastro_id']),
+    ('ix_guias_iptu_ano_exercicio', 'guias_iptu', ['ano_exercicio']),
+    ('ix_guias_iptu_situacao', 'guias_iptu', ['situacao']),
+    ('ix_padroes_construtivos_descricao', 'padroes_construtivos', ['descricao']),
+]
+
+
+def _inspector():
+    return sa.inspect(op.get_bind())
+
+
+def _tabela_existe(tabela):
+    return _inspector().has_table(tabela)
+
+
+def _coluna_existe(tabela, coluna):
+    return any(c['name'] == coluna for c in _inspector().get_columns(tabela))
+
+
+def _indice_existe(tabela, indice):
+    return any(i['name'] == indice for i in _inspector().get_indexes(tabela))
+
+
+def _restricao_unica_existe(tabela, restricao):
+    return any(u['name'] == restricao for u in _inspector().get_unique_constraints(tabela))
+
+
+def upgrade():
+    postgresql = op.get_bind().dialect.name == 'postgresql'
+
+    if not _tabela_existe('versoes_tabelas'):
+        op.create_table(
+            'versoes_tabelas',
+            sa.Column('nome', sa.String(length=50), nullable=False),
+            sa.Column('versao', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('nome'),
+        )
+
+    if not _tabela_existe('tarefas'):
+        op.create_table(
+            'tarefas',
+            sa.Column('id', sa.String(length=36), nullable=False),
+            sa.Column('tipo', sa.String(length=50), nullable=False),
+            sa.Column('status', sa.String(length=20), nullable=False),
+            sa.Column('progresso', sa.Float(), nullable=False),
+            sa.Column('mensagem', sa.Text(), nullable=True),
+            sa.Column('parametros', sa.Text(), nullable=True),
+            sa.Column('resultado', sa.Text(), nullable=True),
+            sa.Column('caminho_arquivo', sa.String(length=512), nullable=True),
+            sa.Column('nome_arquivo', sa.String(length=255), nullable=True),
+            sa.Column('usuario_id', sa.Integer(), nullable=True),
+            sa.Column('data_criacao', sa.DateTime(), nullable=True),
+            sa.Column('data_inicio', sa.DateTime(), nullable=True),
+            sa.Column('data_conclusao', sa.DateTime(), nullable=True),
+            sa.ForeignKeyConstraint(['usuario_id'], ['usuarios.id']),
+            sa.PrimaryKeyConstraint('id'),
+        )
+
+    if not _coluna_existe('cadastros_reurb', 'texto_busca'):
+        op.add_column('cadastros_reurb', sa.Column('texto_busca', sa.Text(), nullable=True))
+
+    for nome, tabela, colunas in INDICES:
+        if not _indice_existe(tabela, nome):
+            op.create_index(nome, tabela, colunas)
+
+    if postgresql and not _indice_existe('cadastros_reurb', 'ix_cadastros_reurb_texto_busca_trgm'):
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        op.create_index('ix_cadastros_reurb_texto_busca_trgm', 'cadastros_reurb', ['texto_busca'],
+                        postgresql_using='gin', postgresql_ops={'texto_busca': 'gin_trgm_ops'})
+
+    if postgresql and not _indice_existe('cadastros_reurb', 'ix_cadastros_reurb_inscricao_pattern'):
+        op.create_index('ix_cadastros_reurb_inscricao_pattern', 'cadastros_reurb', ['inscricao_imobiliaria'],
+                        postgresql_ops={'inscricao_imobiliaria': 'varchar_pattern_ops'})
+
+    if not _restricao_unica_existe('guias_iptu', 'uq_guias_iptu_cadastro_ano'):
+        duplicadas = op.get_bind().execute(sa.text(
+            'SELECT cadastro_id, ano_exercicio FROM guias_iptu '
+            'GROUP BY cadastro_id, ano_exercicio HAVING COUNT(*) > 1 LIMIT 5')).fetchall()
+        if duplicadas:
+            raise RuntimeError(
+                'Existem guias duplicadas para o mesmo cadastro e exercício (ex.: %s). '
+                'Remova as duplicatas antes de aplicar esta migração.' % ', '.join(str(tuple(d)) for d in duplicadas))
+        with op.batch_alter_table('guias_iptu') as batch_op:
+            batch_op.create_unique_constraint('uq_guias_iptu_cadastro_ano', ['cadastro_id', 'ano_exercicio'])
+
+
+def downgrade():
+    # Mesmas verificações do upgrade: remove só o que existe
+    if _restricao_unica_existe('guias_iptu', 'uq_guias_iptu_cadastro_ano'):
+        with op.batch_alter_table('guias_iptu') as batch_op:
+            batch_op.drop_constraint('uq_guias_iptu_cadastro_ano', type_='unique')
+    for nome in ('ix_cadastros_reurb_inscricao_pattern', 'ix_cadastros_reurb_texto_busca_trgm'):
+        if _indice_existe('cadastros_reurb', nome):
+            op.drop_index(nome, table_name='cadastros_reurb')
+    for nome, tabela, _ in reversed(INDICES):
+        if _indice_existe(tabela, nome):
+            op.drop_index(nome, table_name=tabela)
+    if _coluna_existe('cadastros_reurb', 'texto_busca'):
+        with op.batch_alter_table('cadastros_reurb') as batch_op:
+            batch_op.drop_column('texto_busca')
+    for tabela in ('tarefas', 'versoes_tabelas'):
+        if _tabela_existe(tabela):
+            op.drop_table(tabela)
@@ -0,0 +1,52 @@
+"""Armazenamento de documentos por conteúdo (SHA-256 com contagem de referências)
+
+Cria a tabela arquivos_armazenados e a coluna documentos.sha256. Documentos já
+existentes continuam com sha256 nulo e são servidos do caminho original.
+
+Revision ID: b2d4f6a8c0e1
+Revises: a1c3e5f7b9d2
+Create Date: 2026-10-17 15:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2d4f6a8c0e1'
+down_revision = 'a1c3e5f7b9d2'
+branch_labels = None
+depends_on = None
+
+
+def _inspector():
+    return sa.inspect(op.get_bind())
+
+
+def _coluna_existe(tabela, coluna):
+    return any(c['name'] == coluna for c in _inspector().get_columns(tabela))
+
+
+def upgrade():
+    if not _inspector().has_table('arquivos_armazenados'):
+        op.create_table(
+            'arquivos_armazenados',
+            sa.Column('sha256', sa.String(length=64), nullable=False),
+            sa.Column('tamanho', sa.BigInteger(), nullable=False),
+            sa.Column('referencias', sa.Integer(), nullable=False),
+            sa.Column('data_criacao', sa.DateTime(), nullable=True),
+            sa.Column('data_liberacao', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('sha256'),
+        )
+        op.create_index('ix_arquivos_armazenados_data_liberacao', 'arquivos_armazenados', ['data_liberacao'])
+
+    if not _coluna_existe('documentos', 'sha256'):
+        op.add_column('documentos', sa.Column('sha256', sa.String(length=64), nullable=True))
+        op.create_index('ix_documentos_sha256', 'documentos', ['sha256'])
+
+
+def downgrade():
+    op.drop_index('ix_documentos_sha256', table_name='documentos')
+    op.drop_column('documentos', 'sha256')
+    op.drop_index('ix_arquivos_armazenados_data_liberacao', table_name='arquivos_armazenados')
+    op.drop_table('arquivos_armazenados')
@@ -0,0 +1,53 @@
+"""Sincronização incremental: seq_alteracao dos cadastros e registro de exclusões
+
+Cadastros existentes ficam com seq_alteracao = 0 e são entregues na primeira
+sincronização completa (sem cursor).
+
+Revision ID: c3e5a7b9d1f3
+Revises: b2d4f6a8c0e1
+Create Date: 2026-10-17 17:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e5a7b9d1f3'
+down_revision = 'b2d4f6a8c0e1'
+branch_labels = None
+depends_on = None
+
+
+def _inspector():
+    return sa.inspect(op.get_bind())
+
+
+def _coluna_existe(tabela, coluna):
+    return any(c['name'] == coluna for c in _inspector().get_columns(tabela))
+
+
+def upgrade():
+    if not _coluna_existe('cadastros_reurb', 'seq_alteracao'):
+        op.add_column('cadastros_reurb', sa.Column('seq_alteracao', sa.BigInteger(), nullable=False, server_default='0'))
+        op.create_index('ix_cadastros_reurb_seq_alteracao', 'cadastros_reurb', ['seq_alteracao', 'id'])
+
+    if not _inspector().has_table('exclusoes'):
+        op.create_table(
+            'exclusoes',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('tabela', sa.String(length=30), nullable=False),
+            sa.Column('registro_id', sa.Integer(), nullable=False),
+            sa.Column('cadastro_id', sa.Integer(), nullable=False),
+            sa.Column('seq_alteracao', sa.BigInteger(), nullable=False),
+            sa.Column('data_exclusao', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+        )
+        op.create_index('ix_exclusoes_seq_alteracao', 'exclusoes', ['seq_alteracao', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_exclusoes_seq_alteracao', table_name='exclusoes')
+    op.drop_table('exclusoes')
+    op.drop_index('ix_cadastros_reurb_seq_alteracao', table_name='cadastros_reurb')
+    op.drop_column('cadastros_reurb', 'seq_alteracao')
@@ -0,0 +1,28 @@
+"""Chave de idempotência dos cadastros enviados em lote
+
+Revision ID: d4f6b8c0e2a4
+Revises: c3e5a7b9d1f3
+Create Date: 2026-10-17 18:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4f6b8c0e2a4'
+down_revision = 'c3e5a7b9d1f3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    colunas = [c['name'] for c in sa.inspect(op.get_bind()).get_columns('cadastros_reurb')]
+    if 'chave_idempotencia' not in colunas:
+        op.add_column('cadastros_reurb', sa.Column('chave_idempotencia', sa.String(length=100), nullable=True))
+        op.create_index('ix_cadastros_reurb_chave_idempotencia', 'cadastros_reurb', ['chave_idempotencia'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_cadastros_reurb_chave_idempotencia', table_name='cadastros_reurb')
+    op.drop_column('cadastros_reurb', 'chave_idempotencia')
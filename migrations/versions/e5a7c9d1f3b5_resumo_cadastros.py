@@ -0,0 +1,47 @@
+"""Resumo dos cadastros para o dashboard (status, tipo de REURB, riscos e bairro)
+
+Cria a tabela resumo_cadastros já preenchida a partir de cadastros_reurb. Ela
+pode ser recalculada a qualquer momento com:
+    flask --app app reconstruir-resumo
+
+Revision ID: e5a7c9d1f3b5
+Revises: d4f6b8c0e2a4
+Create Date: 2026-10-17 19:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a7c9d1f3b5'
+down_revision = 'd4f6b8c0e2a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if sa.inspect(op.get_bind()).has_table('resumo_cadastros'):
+        return
+    op.create_table(
+        'resumo_cadastros',
+        sa.Column('status', sa.String(length=50), nullable=False),
+        sa.Column('tipo_reurb', sa.String(length=10), nullable=False),
+        sa.Column('risco_inundacao', sa.String(length=10), nullable=False),
+        sa.Column('risco_deslizamento', sa.String(length=10), nullable=False),
+        sa.Column('bairro', sa.String(length=100), nullable=False),
+        sa.Column('quantidade', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('status', 'tipo_reurb', 'risco_inundacao', 'risco_deslizamento', 'bairro'),
+    )
+    # Mesma classificação de classificar_reurb/condicao_reurb_social no app
+    op.execute(
+        "INSERT INTO resumo_cadastros (status, tipo_reurb, risco_inundacao, risco_deslizamento, bairro, quantidade) "
+        "SELECT COALESCE(status, ''), "
+        "CASE WHEN COALESCE(reurb_renda_familiar, 0) <= 7500 AND LOWER(COALESCE(reurb_outro_imovel, '')) = 'nao' "
+        "THEN 'REURB-S' ELSE 'REURB-E' END, "
+        "COALESCE(risco_inundacao, ''), COALESCE(risco_deslizamento, ''), COALESCE(imovel_bairro, ''), COUNT(*) "
+        "FROM cadastros_reurb GROUP BY 1, 2, 3, 4, 5")
+
+
+def downgrade():
+    op.drop_table('resumo_cadastros')
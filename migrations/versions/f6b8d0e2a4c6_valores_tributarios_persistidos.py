@@ -0,0 +1,73 @@
+"""Valores tributários (vvt, vvc, vvi, iptu) e tipo de REURB gravados no cadastro
+
+Adiciona as colunas e as preenche com as mesmas regras de
+CalculoTributarioService.calcular_valores. Depois disso elas são mantidas pelo
+app; para recalcular tudo:
+    flask --app app recalcular-valores
+
+Revision ID: f6b8d0e2a4c6
+Revises: e5a7c9d1f3b5
+Create Date: 2026-10-17 21:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6b8d0e2a4c6'
+down_revision = 'e5a7c9d1f3b5'
+branch_labels = None
+depends_on = None
+
+VALORES = ('vvt', 'vvc', 'vvi', 'iptu')
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    colunas = {coluna['name'] for coluna in inspector.get_columns('cadastros_reurb')}
+    indices_cadastros = {indice['name'] for indice in inspector.get_indexes('cadastros_reurb')}
+    indices_construcoes = {indice['name'] for indice in inspector.get_indexes('construcoes')}
+    with op.batch_alter_table('cadastros_reurb', schema=None) as batch_op:
+        if 'tipo_reurb' not in colunas:
+            batch_op.add_column(sa.Column('tipo_reurb', sa.String(length=10), nullable=True))
+        for nome in VALORES:
+            if nome not in colunas:
+                batch_op.add_column(sa.Column(nome, sa.Float(), nullable=False, server_default='0'))
+        if 'ix_cadastros_reurb_iptu' not in indices_cadastros:
+            batch_op.create_index('ix_cadastros_reurb_iptu', ['iptu', 'id'], unique=False)
+        if 'ix_cadastros_reurb_imovel_logradouro' not in indices_cadastros:
+            batch_op.create_index(batch_op.f('ix_cadastros_reurb_imovel_logradouro'), ['imovel_logradouro'], unique=False)
+    with op.batch_alter_table('construcoes', schema=None) as batch_op:
+        if 'ix_construcoes_uso_principal' not in indices_construcoes:
+            batch_op.create_index(batch_op.f('ix_construcoes_uso_principal'), ['uso_principal'], unique=False)
+        if 'ix_construcoes_padrao_construtivo' not in indices_construcoes:
+            batch_op.create_index(batch_op.f('ix_construcoes_padrao_construtivo'), ['padrao_construtivo'], unique=False)
+
+    # Mesmas regras de CalculoTributarioService.recalcular: primeiro vvt e vvc, depois vvi e iptu
+    op.execute(
+        "UPDATE cadastros_reurb SET "
+        "tipo_reurb = CASE WHEN COALESCE(reurb_renda_familiar, 0) <= 7500 AND LOWER(COALESCE(reurb_outro_imovel, '')) = 'nao' "
+        "THEN 'REURB-S' ELSE 'REURB-E' END, "
+        "vvt = CASE WHEN imovel_area_total > 0 THEN imovel_area_total * COALESCE((SELECT v.valor_m2 FROM valores_logradouro v "
+        "WHERE v.logradouro = cadastros_reurb.imovel_logradouro), 0) ELSE 0 END, "
+        "vvc = COALESCE((SELECT SUM(c.area_construida * COALESCE((SELECT p.valor_m2 FROM padroes_construtivos p "
+        "WHERE p.descricao = c.padrao_construtivo ORDER BY p.id LIMIT 1), 0)) FROM construcoes c "
+        "WHERE c.cadastro_id = cadastros_reurb.id AND c.area_construida > 0), 0)")
+    op.execute(
+        "UPDATE cadastros_reurb SET vvi = vvt + vvc, "
+        "iptu = CASE WHEN vvt + vvc > 0 THEN (vvt + vvc) * COALESCE((SELECT a.aliquota FROM aliquotas_iptu a "
+        "WHERE a.tipo = (SELECT c.uso_principal FROM construcoes c WHERE c.cadastro_id = cadastros_reurb.id "
+        "ORDER BY c.id LIMIT 1)), 0) ELSE 0 END")
+
+
+def downgrade():
+    with op.batch_alter_table('construcoes', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_construcoes_padrao_construtivo'))
+        batch_op.drop_index(batch_op.f('ix_construcoes_uso_principal'))
+    with op.batch_alter_table('cadastros_reurb', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_cadastros_reurb_imovel_logradouro'))
+        batch_op.drop_index('ix_cadastros_reurb_iptu')
+        for nome in reversed(VALORES):
+            batch_op.drop_column(nome)
+        batch_op.drop_column('tipo_reurb')